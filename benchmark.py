@@ -0,0 +1,268 @@
+import asyncio
+import json
+import sys
+from argparse import ArgumentParser
+from statistics import mean
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from pygame import Vector2, Surface, display
+
+import main as game
+
+
+BASELINE = "benchmark.json"
+REGRESSION_THRESHOLD = 0.15  # how much slower than the baseline a benchmark may get before it is flagged
+SEED = 1
+MODES = ("start", "options", "display", "sound", "keybinds", "help", "leaderboard", "levelup", "gameover", "play")
+WINDOW_SIZES = ((500, 500), (1920, 1080), (3840, 2160))
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    return {"mean": mean(times), "p95": game.percentile(times, 95), "p99": game.percentile(times, 99)}
+
+
+def measure(function: Callable[[], Any], iterations: int, setup: Optional[Callable[[], Any]] = None) -> List[float]:
+    """
+    Times a function in milliseconds, running the setup function untimed before every call
+    """
+
+    times = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        times.append((perf_counter() - start) * 1000)
+    return times
+
+
+def keep_alive(hooks: SimpleNamespace) -> None:
+    """
+    Undoes the player crashing so that long benchmarks keep scrolling through the level
+    """
+
+    hooks.player_sprite.mode = ""
+    hooks.player_sprite.timer = None
+    hooks.set_state(new_mode="play", new_pause=False)
+
+
+def new_duck(hooks: SimpleNamespace, position: Vector2) -> game.Sprite:
+    """
+    Creates a duck the same way the world generation does
+    """
+
+    duck = game.Sprite(game.S_DUCK, list(hooks.assets.frames["duck"]), position, hooks.update_duck)
+    duck.bonus, duck.timer, duck.mode, duck.feet, duck.feet_frame = 0, 0, "land", hooks.assets.frames["feet"], 0
+    return duck
+
+
+def start_level(hooks: SimpleNamespace, level: int, ducks: int = 0) -> None:
+    """
+    Resets the game to an empty level, optionally filled with a grid of ducks around the player
+    """
+
+    hooks.reset_game()
+    hooks.set_state(new_mode="play", new_level=level)
+    hooks.reset_level()
+    sprites = hooks.get_sprites()
+    for i in range(ducks):
+        position = Vector2((i % 12 - 5.5) * 20, 32 + (i // 12) * 20 % 224)
+        sprites.add(new_duck(hooks, position))
+    sprites.flush()
+
+
+def play_frame(hooks: SimpleNamespace) -> None:
+    """
+    Runs one tick of the simulation and draws the frame, like the game loop does at its target frame rate
+    """
+
+    hooks.simulate(hooks.tick_time)
+    hooks.update()
+    keep_alive(hooks)
+
+
+def warm_up(hooks: SimpleNamespace, level: int, ticks: int) -> None:
+    """
+    Plays a level for a while so that the world is filled the way it is during play
+    """
+
+    start_level(hooks, level)
+    for _ in range(ticks):
+        hooks.simulate(hooks.tick_time)
+        keep_alive(hooks)
+
+
+def run_frames(hooks: SimpleNamespace, iterations: int, frames: int, setup: Callable[[], Any]) -> List[float]:
+    """
+    Times every frame of a scenario that is set up again every given number of frames
+    """
+
+    times = []
+    while len(times) < iterations:
+        setup()
+        times += measure(lambda: play_frame(hooks), min(frames, iterations - len(times)))
+    return times
+
+
+def run_suite(hooks: SimpleNamespace, iterations: int, only: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Runs every benchmark whose name contains the given filter and returns their timings
+    """
+
+    results = {}
+
+    def bench(name: str, function: Callable[[], List[float]]) -> None:
+        if only and only not in name:
+            return
+        times = function()
+        results[name] = summarize(times)
+        print(f"{name:<32}{results[name]['mean']:>10.3f}{results[name]['p95']:>10.3f}{results[name]['p99']:>10.3f}")
+
+    print(f"{'benchmark (ms)':<32}{'mean':>10}{'p95':>10}{'p99':>10}")
+
+    # loading everything up to the first frame only happens once, so this is a single sample
+    bench("startup", lambda: [hooks.startup_time * 1000])
+
+    # isolated code paths
+    start_level(hooks, 1)
+    ducks = [new_duck(hooks, Vector2((i % 10 - 5) * 12, (i // 10) * 12)) for i in range(100)]
+    bench("Sprite.colliding x100", lambda: measure(lambda: [d.colliding(ducks[i - 1]) for i, d in enumerate(ducks)],
+                                                    iterations))
+    surface = Surface((game.RESOLUTION, game.RESOLUTION)).convert_alpha()
+    bench("Sprite.draw x100", lambda: measure(lambda: [d.draw(surface, hooks.player_sprite, 0.5, Vector2(0, 0),
+                                                              hooks.ui, 3, 1, False) for d in ducks], iterations))
+    for level in (1, 2, 3):
+        def world_load_setup() -> None:
+            sprites = hooks.get_sprites()
+            sprites.clear()
+            for sprite in world:
+                sprites.add(sprite)
+            sprites.flush()
+            hooks.sprite_grid.rebuild(sprites)
+            hooks.pregenerate()
+
+        bench(f"generate level {level}", lambda: measure(hooks.pregenerate, iterations // 20 or 1,
+                                                         lambda: start_level(hooks, level)))
+        warm_up(hooks, level, 600)
+        world = list(hooks.get_sprites().all())
+        bench(f"world_load level {level}", lambda: measure(hooks.world_load, iterations, world_load_setup))
+    for mode in MODES:
+        if mode == "play":
+            warm_up(hooks, 1, 600)
+        bench(f"update() {mode}", lambda: measure(hooks.update, iterations,
+                                                  lambda: hooks.set_state(new_mode=mode, new_pause=False,
+                                                                          new_anim_timer=0)))
+
+    def start_transition() -> None:
+        hooks.set_state(new_mode="start")
+        hooks.trans("options", game.MENU_TRANSITION_TIME)
+
+    bench("menu transition start", lambda: measure(start_transition, iterations))
+    bench("update() transition", lambda: measure(hooks.update, iterations, start_transition))
+    bench("render_text help", lambda: measure(lambda: game.render_text(hooks.use_font, game.HELP_TEXT, screen=surface),
+                                              iterations))
+    bench("render_text score", lambda: measure(lambda: game.render_text(hooks.score_font, "1234", screen=surface),
+                                               iterations))
+    hooks.set_state(new_mode="play")  # menus only redraw what changed, so time the path every play frame takes
+    for size in WINDOW_SIZES:
+        display.set_mode(size)
+        game_surf = Surface((game.RESOLUTION, game.RESOLUTION)).convert_alpha()
+        bench(f"present {size[0]}x{size[1]}",
+              lambda: measure(lambda: hooks.present(game_surf, game.get_game_screen(3), "play"), iterations))
+    display.set_mode(WINDOW_SIZES[0])
+    bench("UserInterface.update", lambda: measure(hooks.quick_keys.update, iterations))
+    bench("UserInterface.load", lambda: measure(lambda: hooks.quick_keys.load(game.KEY_BINDS), iterations))
+    bench("UserInterface()", lambda: measure(game.UserInterface, iterations))
+
+    def sound_burst() -> None:
+        for i in range(30):  # like a cannon volley hitting a screen full of ducks in one frame
+            hooks.sfx[("quack1", "quack2")[i % 2]].play()
+        hooks.sfx.update(0.5)
+
+    bench("sound effects burst x30", lambda: measure(sound_burst, iterations))
+    bench("leaderboard read", lambda: measure(hooks.get_leaderboard_position, iterations))
+    large_leaderboard = game.Leaderboard(None, 100)
+    for i in range(100):
+        large_leaderboard.insert("AAA", i * 10)
+    bench("leaderboard insert top 100", lambda: measure(lambda: large_leaderboard.insert("BBB", 495), iterations))
+    bench("leaderboard rows top 100", lambda: measure(lambda: large_leaderboard.get_rows(495, "BB_"), iterations))
+
+    # synthetic stress scenarios
+    for count in (20, 60, 120):
+        bench(f"stress {count} ducks", lambda: run_frames(hooks, iterations, 60, lambda: start_level(hooks, 1, count)))
+    for count in (1000, 5000):  # far more sprites than a level ever has, to see how the per-sprite costs scale
+        many_ducks = [new_duck(hooks, Vector2((i % 20 - 10) * 12, i // 20 % 20 * 12)) for i in range(count)]
+        bench(f"Sprite.integrate x{count}", lambda: measure(
+            lambda: game.Sprite.integrate(many_ducks, Vector2(0, 0.5), hooks.tick_time), iterations))
+        # the callbacks and collisions of this many ducks take seconds a tick, so it only gets a few samples
+        bench(f"stress {count} ducks tick", lambda: measure(lambda: hooks.simulate(hooks.tick_time),
+                                                            iterations // 40 or 1,
+                                                            lambda: start_level(hooks, 1, count)))
+
+    def cannon_volley() -> None:
+        start_level(hooks, 1, 50)
+        cannon = game.Sprite(game.S_LOAF, list(hooks.assets.frames["cannon"]), Vector2(hooks.player_sprite.position),
+                             hooks.update_cannon)
+        hooks.get_sprites().add(cannon)
+        hooks.get_sprites().flush()
+
+    bench("stress cannon volley 50 ducks", lambda: run_frames(hooks, iterations, 90, cannon_volley))
+
+    def level_3_road() -> None:
+        start_level(hooks, 3)
+        sprites = hooks.get_sprites()
+        for y in range(64, 256, 48):
+            road = game.Sprite(game.S_ROAD, [hooks.road_img], Vector2(0, y), hooks.update_road)
+            road.timer = 0
+            sprites.add(road)
+            for x in range(-96, 128, 64):
+                vehicle = game.Sprite(game.S_OBSTACLE, list(hooks.assets.frames["vehicle"]), Vector2(x, y),
+                                      hooks.update_obstacle)
+                vehicle.mode = "vehicle"
+                sprites.add(vehicle)
+        sprites.flush()
+
+    bench("stress level 3 road", lambda: run_frames(hooks, iterations, 120, level_3_road))
+
+    # end to end
+    bench("play level 1", lambda: run_frames(hooks, iterations, iterations, lambda: start_level(hooks, 1)))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]) -> List[str]:
+    """
+    Prints how every benchmark changed against the baseline and returns the names of the ones that regressed
+    """
+
+    regressions = []
+    print(f"\n{'compared to baseline':<32}{'mean':>10}{'p95':>10}{'p99':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes = {k: result[k] / baseline[name][k] - 1 if baseline[name][k] else 0.0 for k in result}
+        flag = ""
+        if changes["mean"] > REGRESSION_THRESHOLD or changes["p95"] > REGRESSION_THRESHOLD:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<32}{changes['mean']:>+10.1%}{changes['p95']:>+10.1%}{changes['p99']:>+10.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks for Roboduck's hot paths")
+    parser.add_argument("--iterations", type=int, default=200, help="number of timed runs of every benchmark")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--save", nargs="?", const=BASELINE, metavar="FILE", help="store the results as a baseline")
+    parser.add_argument("--compare", nargs="?", const=BASELINE, metavar="FILE",
+                        help="flag benchmarks that got slower than a stored baseline")
+    args = parser.parse_args()
+
+    suite_results = asyncio.run(game.main(headless=True, seed=SEED,
+                                          benchmark=lambda hooks: run_suite(hooks, args.iterations, args.only)))
+    if args.save:
+        game.write(args.save, json.dumps(suite_results, indent=4).split("\n"))
+    if args.compare:
+        if compare(suite_results, json.loads("\n".join(game.read(args.compare)))):
+            sys.exit(1)
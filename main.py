@@ -1,8 +1,23 @@
 import asyncio
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from itertools import chain
 from pygame import *
+from time import perf_counter
 from math import floor, copysign
-from random import randint
-from typing import Any, Optional, Union, Callable, Sequence, Tuple, List, Dict
+from random import Random
+from types import SimpleNamespace
+from typing import Any, Optional, Union, Callable, Sequence, Iterable, Iterator, Deque, Tuple, List, Dict, Set
+from weakref import WeakKeyDictionary
+
+try:
+    import resource
+except ImportError:  # only available on unix
+    resource = None
 
 
 ENABLE_CONTROLLERS = True
@@ -23,8 +38,13 @@ SPLASH = "assets/splash.png"
 SHEET_SPRITE = "assets/spritesheet.png"
 SHEET_UI = "assets/controller.png"
 SOUND_MUSIC = "assets/music.ogg"
+SOUND_CACHE = "assets/sound cache"  # sound effects decoded to raw samples for the mixer's format
 SOUND_SFX = ("assets/quack1.ogg", "assets/quack2.ogg", "assets/quack3.ogg", "assets/grass1.ogg", "assets/grass2.ogg",
              "assets/error.ogg", "assets/cannon.ogg", "assets/levelup.ogg", "assets/gameover.ogg")
+SOUND_CHANNELS = {"ducks": 4, "effects": 3, "jingles": 1}  # mixer channels set aside for each kind of sound effect
+SOUND_KINDS = {"quack1": "ducks", "quack2": "ducks", "quack3": "ducks", "grass1": "effects", "grass2": "effects",
+               "error": "effects", "cannon": "effects", "levelup": "jingles", "gameover": "jingles"}
+MAX_VOICES = 2  # most copies of one sound effect that can play at the same time
 
 # set global variables
 UI_CROP = {
@@ -42,56 +62,162 @@ UI_CROP = {
     "leftshoulder.ps": Rect(0, 9, 1, 1), "rightshoulder.ps": Rect(1, 9, 1, 1),
     "leftstick": Rect(0, 10, 1, 1), "rightstick": Rect(1, 10, 1, 1),
     "leftx": Rect(2, 10, 1, 1), "rightx": Rect(3, 10, 1, 1)}
+SPRITE_FRAMES = {  # named frames cut out of the sprite sheet, every level's obstacles and decorators in order
+    "player": ((0, 0, 16, 16), (16, 0, 16, 16)),
+    "tracks": ((32, 0, 16, 8), (48, 0, 16, 8), (32, 8, 16, 8), (48, 8, 16, 8)),
+    "duck": ((0, 16, 16, 16), (16, 16, 16, 16), (32, 16, 16, 16), (48, 16, 16, 16)),
+    "feet": ((48, 32, 8, 8), (56, 32, 8, 8), (48, 40, 8, 8), (56, 40, 8, 8)),
+    "bread": ((0, 32, 16, 16),), "loaf": ((16, 40, 16, 8),), "cannon": ((32, 32, 16, 16),),
+    "vehicle": ((0, 96, 32, 16), (32, 96, 32, 16)), "road": ((0, 64, 16, 16),), "icon": ((48, 128, 16, 16),),
+    "bar modes": ((0, 144, 16, 16), (16, 144, 16, 16), (32, 144, 16, 16), (48, 144, 16, 16)),
+    "obstacles 1": ((32, 48, 16, 32), (0, 80, 32, 16), (32, 80, 16, 16), (48, 80, 16, 16)),
+    "obstacles 2": ((32, 128, 16, 16), (0, 112, 32, 16), (32, 112, 32, 16)),
+    "obstacles 3": ((48, 48, 16, 16), (48, 64, 16, 16), (32, 48, 16, 32), (32, 80, 16, 16)),
+    "decorators 1": ((0, 128, 8, 8), (8, 128, 8, 8), (0, 136, 8, 8), (8, 136, 8, 8)),
+    "decorators 2": ((16, 128, 8, 8), (24, 128, 8, 8), (16, 136, 8, 8), (24, 136, 8, 8)),
+    "decorators 3": ((0, 128, 8, 8), (8, 128, 8, 8), (0, 136, 8, 8), (8, 136, 8, 8))}
 KEYBOARD_ID = "0" * 32
 RESOLUTION = 256
 QUICK_KEYBINDS = 10
 CONTROLLER_SENSITIVITY = 0.1
+JOYSTICK_EVENTS = (JOYBUTTONDOWN, JOYBUTTONUP, JOYHATMOTION, JOYAXISMOTION)
+IGNORED_EVENTS = (KEYUP, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEWHEEL, TEXTEDITING, FINGERDOWN, FINGERUP, FINGERMOTION,
+                  MULTIGESTURE, JOYBALLMOTION, CONTROLLERAXISMOTION, CONTROLLERBUTTONDOWN, CONTROLLERBUTTONUP,
+                  DROPBEGIN, DROPCOMPLETE, DROPFILE, DROPTEXT, AUDIODEVICEADDED, AUDIODEVICEREMOVED)
 MENU_TRANSITION_TIME = 700
+TICK_RATE = 60  # number of simulation ticks per second, independent of the frame rate
+MAX_FRAME_TIME = 250  # longest frame in milliseconds the simulation will try to catch up on
+FRAMERATE = 60  # frame rate the game is drawn at by default, 0 for as fast as possible
+FRAMERATES = (30, 60, 120, 144, 0)
+MAX_FRAME_SKIP = 4  # most frames in a row that only run the simulation when drawing can't keep up with the frame rate
+SLEEP_PRECISION = 0.002  # seconds before a frame is due that waiting for it stops sleeping and starts spinning
+IDLE_FRAMERATE = 20  # frame rate of menus once nothing has changed on them for IDLE_DELAY frames
+IDLE_DELAY = 30
+WORLD_GENERATION_BUDGET = 0.5  # share of a frame's time after which no more rows are generated ahead of the player
+MENU_MODES = ("start", "options", "display", "sound", "keybinds", "help", "leaderboard", "levelup", "gameover")
+MENU_WIDGETS = {"start": 0, "options": 1, "display": 2, "sound": 3, "keybinds": 4, "help": 8}  # menus with transitions
+HELP_TEXT = ("Throw bread at ducks to earn points\nwhile also dodging everything\nthat's in your way.\n"
+             "If you can hit the same duck twice\nyou get three points from it.\n"
+             "Collect loaves off the floor for\nmore bread to throw.\n"
+             "Rare bread cannons can be used to\nfeed all ducks on screen\nat the same time.\n"
+             "Most importantly, have fun!")
 S_NUM_TYPES = 7
 S_DECORATOR, S_ROAD, S_OBSTACLE, S_LOAF, S_DUCK, S_BREAD, S_PLAYER = range(S_NUM_TYPES)
+S_NAMES = ("decorator", "road", "obstacle", "loaf", "duck", "bread", "player")
+PERFORMANCE_HUD_KEY = K_F3
+LEADERBOARD_SIZE = 5  # number of scores kept on the leaderboard
+LEADERBOARD_ROWS = 5  # number of scores shown on the leaderboard screen at once
+TEXT_CACHE_SIZE = 256  # number of rendered lines of text kept around before the least recently used is dropped
 
 GREY_GREEN = (127, 191, 127)
 
 
-class UserInterface:
+class DeviceDatabase:
     """
-    class for handling user input
+    class for the controller mappings and key binds shared by every device, each file only being read once
     """
 
-    UI_TYPE = Tuple[Union[Sequence[bool], Sequence[float]]]  # type used to store sequences of user-input data
+    # controller mappings keyed by GUID, kept as their line of the file until a device with that GUID is used, and the
+    # key bind lines of every device keyed by file and then by device name
+    mappings: Dict[str, Union[str, List[List[str]]]] = {}
+    binds: Dict[str, Dict[str, List[str]]] = {}
+
+    @staticmethod
+    def get_mapping(guid: str) -> List[List[str]]:
+        """
+        Returns the names of a device's buttons, hats and axes from the "controllers.dat" file
+        """
+
+        mappings = DeviceDatabase.mappings
+        if not mappings:
+            for line in read(CONTROLLERS):
+                if line:
+                    mappings[line.split(":")[0]] = line
+        mapping = mappings[guid]
+        if isinstance(mapping, str):
+            mapping = mappings[guid] = [device.split(",") for device in mapping.split(":")[1].split("|")]
+        return mapping
+
+    @staticmethod
+    def get_binds(file: str) -> Dict[str, List[str]]:
+        """
+        Returns the key bind lines of every device in a key binds file
+        """
+
+        binds = DeviceDatabase.binds.get(file)
+        if binds is None:
+            binds = DeviceDatabase.binds[file] = {}
+            device_name = None
+            for line in read(file):
+                if device_name is not None and line:
+                    binds[device_name].append(line)
+                elif line:
+                    device_name = line
+                    binds[device_name] = []
+                else:
+                    device_name = None
+        return binds
+
+    @staticmethod
+    def set_binds(file: str, device_name: str, lines: List[str]) -> None:
+        """
+        Changes the key bind lines of a device, writing the file only when they are different
+        """
+
+        binds = DeviceDatabase.get_binds(file)
+        if binds.get(device_name) != lines:
+            binds[device_name] = lines
+            DeviceDatabase.save_binds(file)
 
     @staticmethod
-    def read_controllers(file: str) -> Dict[str, List[List[str]]]:
+    def reset_binds(file: str, default: str) -> None:
         """
-        Returns a dictionary representation of the "controllers.dat" file
+        Replaces the key binds of every device with the ones in the default file
         """
 
-        contents = read(file)
-        keys, values = [], []
-        for line in contents:
-            line = line.split(":")
-            keys.append(line[0])
-            value = line[1]
-            new_value = []
-            for device in value.split("|"):
-                new_value.append(device.split(","))
-            values.append(new_value)
-        return dict(zip(keys, values))
+        DeviceDatabase.binds[file] = {k: v[:] for k, v in DeviceDatabase.get_binds(default).items()}
+        DeviceDatabase.save_binds(file)
+
+    @staticmethod
+    def save_binds(file: str) -> None:
+        """
+        Writes the key binds of every device back to their file
+        """
+
+        write(file, [line for device_name, lines in DeviceDatabase.binds[file].items()
+                     for line in [device_name] + lines + [""]])
+
+
+class UserInterface:
+    """
+    class for handling user input
+    """
+
+    UI_TYPE = Tuple[Union[Sequence[bool], Sequence[float]]]  # type used to store sequences of user-input data
 
     def __init__(self, device: int = -1, img: Optional[Surface] = None):
         self.img = img
         self.key_binds: Dict[str, Tuple[int, int]] = {}
+        self.images: Dict[Tuple[font.Font, Tuple[int, int]], Surface] = {}  # images of the inputs keys are bound to
         self.device: Optional[joystick.Joystick] = None
         self.device_name: str = "Mouse and Keyboard"
         self.device_id: str = KEYBOARD_ID
+        self.current: UI.UI_TYPE = ([],)
+        self.last: UI.UI_TYPE = self.current
+        self.held: Set[int] = set()  # buttons held on the controller as of the last update
+        self.moved: Optional[int] = None  # first of the controller's axis pairs that moved in the last update
         if device != -1:
             self.device = joystick.Joystick(device)
             self.device_name = self.device.get_name()
             self.device_id = self.device.get_guid()
             self.device.init()
-        self.current: UI.UI_TYPE = ([],)
-        self.last: UI.UI_TYPE = self.current
-        self.controllers = UI.read_controllers(CONTROLLERS)[self.device_id]
+            # the controller's state as its events come in, picked up by the next update
+            self.live = ([bool(self.device.get_button(i)) for i in range(self.device.get_numbuttons())],
+                         [self.device.get_hat(i) for i in range(self.device.get_numhats())],
+                         [self.device.get_axis(i) for i in range(self.device.get_numaxes())])
+            self.live_held = {i for i, pressed in enumerate(self.live[0]) if pressed}
+            self.live_axes: Set[int] = set()  # axis pairs that moved since the last update
+        self.controllers = DeviceDatabase.get_mapping(self.device_id)
 
     def __str__(self) -> str:
         return f"{self.device_name}:{self.device_id}"
@@ -111,12 +237,7 @@ class UserInterface:
         Saves key bind data to a given file
         """
 
-        contents = read(file)
-        if f"{self.device_name}" in contents:  # if the key bind data already exists then delete it to be replaced
-            i = contents.index(self.device_name)
-            del contents[i:contents.index('', i) + 1]
-        contents += repr(self).split("\n")
-        write(file, contents)
+        DeviceDatabase.set_binds(file, self.device_name, repr(self).split("\n")[1:-1])
 
     def load(self, file: str) -> None:
         """
@@ -125,8 +246,8 @@ class UserInterface:
 
         if self.device is not None:
             self.key_binds = {str(i): (0, 0) for i in range(QUICK_KEYBINDS)}
-        contents = read(file)
-        if self.device_name not in contents:
+        binds = DeviceDatabase.get_binds(file).get(self.device_name)
+        if binds is None:
             self.key_binds.update({i: (0, 0) for i in ("Left", "Right", "Throw", "Aim", "Menu")})
             keys = ("dpleft", "dpright", "rightshoulder", "rightx", "start")
             for a, l in enumerate(self.controllers):
@@ -135,30 +256,93 @@ class UserInterface:
                         i = list(self.key_binds.keys())[keys.index(i) + QUICK_KEYBINDS]
                         self.key_binds[i] = (a, b)
         else:
-            i = contents.index(self.device_name)
-            contents = contents[i + 1:contents.index('', i)]
-            for i in contents:
+            for i in binds:
                 i = i.split(':')
                 self.key_binds[i[0]] = (int(i[1]), int(i[2]))
 
-    def update(self) -> None:
+    def handle_event(self, e: event.Event) -> None:
         """
-        Updates user-input data
+        Applies a joystick event to the state of the controller it came from
         """
 
+        if self.device is None or e.instance_id != self.device.get_instance_id():
+            return
+        if e.type == JOYAXISMOTION:
+            self.live[2][e.axis] = e.value
+            self.live_axes.add(e.axis // 2 * 2)
+        elif e.type == JOYHATMOTION:
+            self.live[1][e.hat] = e.value
+        elif e.type == JOYBUTTONDOWN:
+            self.live[0][e.button] = True
+            self.live_held.add(e.button)
+        elif e.type == JOYBUTTONUP:
+            self.live[0][e.button] = False
+            self.live_held.discard(e.button)
+
+    def update(self, state: Optional[List[list]] = None) -> None:
+        """
+        Updates user-input data, either from the device or from a recorded state
+        """
+
+        if state is not None:
+            self.set_state(state)
+            return
         self.last = self.current
         if self.device is None:
             self.current = (key.get_pressed(), mouse.get_pressed(5), mouse.get_pos())
         else:
-            self.current = ([self.device.get_button(i) for i in range(self.device.get_numbuttons())],
-                            [self.device.get_hat(i) for i in range(self.device.get_numhats())],
-                            [self.device.get_axis(i) for i in range(self.device.get_numaxes())])
-            if len(self.last) == len(self.current):
-                for i, j in enumerate(self.current[2]):
-                    if abs(j) < CONTROLLER_SENSITIVITY:
-                        i = i // 2 * 2
-                        self.current[2][i] = self.last[2][i]
-                        self.current[2][i + 1] = self.last[2][i + 1]
+            buttons, hats, axes = self.live
+            self.held = set(self.live_held)
+            self.moved = None
+            if len(self.last) == len(self.live):
+                # a stick only moves once both of its axes are outside the dead zone
+                current_axes = self.last[2][:]
+                for i in sorted(self.live_axes):
+                    pair = axes[i:i + 2]
+                    if current_axes[i:i + 2] != pair and all(abs(j) >= CONTROLLER_SENSITIVITY for j in pair):
+                        current_axes[i:i + 2] = pair
+                        if self.moved is None:
+                            self.moved = i
+            else:
+                current_axes = axes[:]
+            self.live_axes.clear()
+            self.current = (buttons[:], hats[:], current_axes)
+
+    def get_state(self) -> List[list]:
+        """
+        Returns a compact copy of the current user-input data, used for recording sessions
+        """
+
+        state = []
+        for i, inputs in enumerate(self.current):
+            if i < 1 + (self.device is None):  # keys and buttons are stored as the indices of the pressed ones
+                state.append([len(inputs)] + [j for j, pressed in enumerate(inputs) if pressed])
+            else:
+                state.append([list(j) if isinstance(j, tuple) else j for j in inputs])
+        return state
+
+    def set_state(self, state: List[list]) -> None:
+        """
+        Replaces the current user-input data with one returned by get_state
+        """
+
+        current = []
+        for i, inputs in enumerate(state):
+            if i < 1 + (self.device is None):
+                pressed = [False] * inputs[0]
+                for j in inputs[1:]:
+                    pressed[j] = True
+                if i == 0 and self.device is None:
+                    pressed = key.ScancodeWrapper(pressed)
+                current.append(pressed)
+            else:
+                current.append([tuple(j) if isinstance(j, list) else j for j in inputs])
+        self.last = self.current
+        self.current = tuple(current)
+        if self.device is not None:
+            self.held = {i for i, pressed in enumerate(self.current[0]) if pressed}
+            moved = [i for i, j in enumerate(self.current[2]) if len(self.last) < 3 or j != self.last[2][i]]
+            self.moved = moved[0] // 2 * 2 if moved else None
 
     def pressed(self, button: str) -> bool:
         """
@@ -180,25 +364,19 @@ class UserInterface:
         Returns any key, button, mouse, or joystick being used by the user
         """
 
-        for i, inputs in enumerate(self.current):
-            if len(inputs) > 0:
-                if isinstance(inputs[0], float) or (self.device_id == KEYBOARD_ID and i == 2):
-                    if button_or_cursor > 0:
-                        for j, pressed in enumerate(inputs):
-                            if self.device_id == KEYBOARD_ID and i == 2:
-                                pressed = mouse_movement
-                            elif pressed == self.last[i][j]:
-                                pressed = (0, 0)
-                            if pressed != (0, 0):
-                                return i, j // 2 * 2
-                elif button_or_cursor != 1:
-                    if self.device_id == KEYBOARD_ID and i == 0:
-                        if event_keyboard:
-                            return i, event_keyboard[0]
-                    else:
-                        lst = inputs[:]
-                        if True in lst:
-                            return i, lst.index(True)
+        if self.device is None:
+            if button_or_cursor != 1:
+                if event_keyboard:
+                    return 0, event_keyboard[0]
+                if True in self.current[1]:
+                    return 1, list(self.current[1]).index(True)
+            if button_or_cursor > 0 and mouse_movement:
+                return 2, 0
+        else:
+            if button_or_cursor != 1 and self.held:
+                return 0, min(self.held)
+            if button_or_cursor > 0 and self.moved is not None:
+                return 2, self.moved
 
     def get_cursor(self, button: str, point: Vector2, bar_mode: int) -> Vector2:
         """
@@ -208,7 +386,7 @@ class UserInterface:
         button = self.key_binds[button]
         i = self.current[button[0]]
         if self.device_id == KEYBOARD_ID:
-            c = mouse_pos(bar_mode)
+            c = mouse_pos(bar_mode, i)
             c[0] -= RESOLUTION // 2
             c[1] = RESOLUTION - c[1]
             c -= point
@@ -221,11 +399,23 @@ class UserInterface:
 
     def get_image(self, button: str, use_font: font.Font) -> Surface:
         """
-        Returns an image corresponding to the given key, button, mouse, joystick, or trackball
+        Returns an image corresponding to the given key, button, mouse, joystick, or trackball, only making it the
+        first time that input is bound
+        """
+
+        image_key = (use_font, self.key_binds[button])
+        image = self.images.get(image_key)
+        if image is None:
+            image = self.images[image_key] = self.make_image(button, use_font)
+        return image
+
+    def make_image(self, button: str, use_font: font.Font) -> Surface:
+        """
+        Draws the image of the given key, button, mouse, joystick, or trackball
         """
 
         if self.device_id == KEYBOARD_ID and self.key_binds[button][0] == 0:
-            text = use_font.render(key.name(self.key_binds[button][1]).capitalize(), False, Color("White"))
+            text = TextCache.render(use_font, key.name(self.key_binds[button][1]).capitalize(), Color("White"))
             size = Vector2(text.get_size()) + Vector2(4, 3)
             padding = 0
             if size[0] < 16:
@@ -255,8 +445,61 @@ UI = UserInterface  # shorter name for the UserInterface class
 
 class Sprite:
 
+    # flipped images and collision masks shared by every sprite, keyed by costume surface and then by flip state
+    flips: "WeakKeyDictionary[Surface, Dict[Tuple[bool, bool], Surface]]" = WeakKeyDictionary()
+    masks: "WeakKeyDictionary[Surface, Dict[Tuple[bool, bool], mask.Mask]]" = WeakKeyDictionary()
+    shadows: "WeakKeyDictionary[Surface, Surface]" = WeakKeyDictionary()
+
+    @staticmethod
+    def flip_image(surface: Surface, flip_x: bool, flip_y: bool) -> Surface:
+        """
+        Returns a flipped version of the given surface, only creating it the first time it is needed
+        """
+
+        if not (flip_x or flip_y):
+            return surface
+        flip = (bool(flip_x), bool(flip_y))
+        surface_flips = Sprite.flips.get(surface)
+        if surface_flips is None:
+            surface_flips = Sprite.flips[surface] = {}
+        image = surface_flips.get(flip)
+        if image is None:
+            image = surface_flips[flip] = transform.flip(surface, *flip)
+        return image
+
+    @staticmethod
+    def invalidate_costume(surface: Surface) -> None:
+        """
+        Forgets the cached images and masks made from a costume; call this after changing a costume at runtime
+        """
+
+        for image in Sprite.flips.pop(surface, {}).values():
+            Sprite.shadows.pop(image, None)
+        Sprite.shadows.pop(surface, None)
+        Sprite.masks.pop(surface, None)
+
+    @staticmethod
+    def integrate(entities: Iterable["Sprite"], scroll: Vector2, dt: float) -> List["Sprite"]:
+        """
+        Damps the velocity of every given sprite, moves it along with the scrolling of the world in one pass over all
+        of them, and returns the ones that went off screen
+        """
+
+        distance = 128 * dt / 1000
+        scroll = scroll * distance
+        off_screen = []
+        for entity in entities:
+            if entity.deleted:
+                continue
+            velocity, position = entity.velocity, entity.position
+            velocity *= 0.99
+            position += velocity * distance - scroll
+            if abs(position[0]) > 144 or position[1] < -64:
+                off_screen.append(entity)
+        return off_screen
+
     def __init__(self, sprite_type, costumes: List[Surface], position: Vector2,
-                 on_update: Callable[[Any], None] = lambda self_: None):
+                 on_update: Callable[[Any, float], None] = lambda self_, dt: None):
         self.sprite_type = sprite_type
         self.velocity: Vector2 = Vector2(0, 0)
         self.costumes = costumes
@@ -264,28 +507,27 @@ class Sprite:
         self.flip_costume: List[bool, bool] = [False, False]
         self.arrange: Vector2 = Vector2(0, -1)
         self.position: Vector2 = position
-        self.update: Callable[[Sprite], None] = on_update
+        self.update: Callable[[Sprite, float], None] = on_update
 
         self.mode = ""
         self.timer = None
         self.bonus = None
         self.feet = None
         self.feet_frame = None
+        self.deleted = False
 
     def delete(self, sprites):
         """
-        Removes the sprite from a given list
+        Removes the sprite from the given sprite store
         """
 
-        sprite_type = sprites[self.sprite_type]
-        if self in sprite_type:
-            del sprite_type[sprite_type.index(self)]
+        sprites[self.sprite_type].remove(self)
 
     def get_image(self) -> Surface:
-        return transform.flip(self.costumes[self.costume], self.flip_costume[0], self.flip_costume[1])
+        return Sprite.flip_image(self.costumes[self.costume], self.flip_costume[0], self.flip_costume[1])
 
     def get_size(self) -> Vector2:
-        return Vector2(self.get_image().get_size())
+        return Vector2(self.costumes[self.costume].get_size())
 
     def get_screen_position(self) -> Vector2:
         """Converts the sprite's unit position to its position on screen"""
@@ -326,14 +568,12 @@ class Sprite:
 
         self.position += vector
 
-    def draw(self, screen: Surface, paused: bool, player: Any, player_speed: float, aim_override: Vector2, ui: UI,
+    def draw(self, screen: Surface, player: Any, player_speed: float, aim_override: Vector2, ui: UI,
              bar_mode: int, level: int, pause: bool) -> None:
         """
         Blits the sprite onto the given surface
         """
 
-        if not paused:
-            self.update(self)
         if self.sprite_type == S_DUCK and (level != 2 or self.mode == "full"):
             self.draw_feet(screen)
         elif self.sprite_type == S_BREAD:
@@ -352,9 +592,12 @@ class Sprite:
 
         down = round((player.position[1] - self.position[1]) * (self.velocity[1] - player_speed) / 8)
         if down < 0:
-            costume = self.get_image().copy()
-            costume.fill((0, 0, 0, 127), None, BLEND_RGBA_MULT)
-            screen.blit(costume, (self.get_screen_position() - Vector2(0, down))[:])
+            costume = self.get_image()
+            shadow = Sprite.shadows.get(costume)
+            if shadow is None:
+                shadow = Sprite.shadows[costume] = costume.copy()
+                shadow.fill((0, 0, 0, 127), None, BLEND_RGBA_MULT)
+            screen.blit(shadow, (self.get_screen_position() - Vector2(0, down))[:])
 
     def draw_laser(self, screen: Surface, ui: UI, bar_mode: int, override: bool, aim_override: Vector2 = None) -> None:
         v_start = self.position + Vector2(0, 8)
@@ -369,29 +612,190 @@ class Sprite:
         draw.line(screen, Color("red"), v_start, v_start + v_aim)
 
     def draw_feet(self, screen: Surface) -> None:
-        img = self.feet[self.feet_frame // 100]
-        img = transform.flip(img, *self.flip_costume)
+        img = self.feet[int(self.feet_frame // 100)]
+        img = Sprite.flip_image(img, *self.flip_costume)
         screen.blit(img, (self.get_screen_position() + Vector2(4, 12))[:])
 
+    def get_mask(self) -> mask.Mask:
+        """
+        Returns the collision mask of the current costume, only building it the first time it is needed
+        """
+
+        costume = self.costumes[self.costume]
+        flip = (bool(self.flip_costume[0]), bool(self.flip_costume[1]))
+        costume_masks = Sprite.masks.get(costume)
+        if costume_masks is None:
+            costume_masks = Sprite.masks[costume] = {}
+        costume_mask = costume_masks.get(flip)
+        if costume_mask is None:
+            costume_mask = costume_masks[flip] = mask.from_surface(self.get_image())
+        return costume_mask
+
     def colliding(self, *others) -> bool:
         others: Tuple[Sprite]
-        mask1 = mask.from_surface(self.get_image())
+        mask1 = None
+        width, height = self.costumes[self.costume].get_size()
         for other in others:
-            mask2 = mask.from_surface(other.get_image())
             offset = other.position - self.position
-            offset: any
-            if mask1.overlap(mask2, offset):
+            offset = int(offset[0]), int(offset[1])
+            other_width, other_height = other.costumes[other.costume].get_size()
+            # cheap bounding box test before touching any masks
+            if not (-other_width < offset[0] < width and -other_height < offset[1] < height):
+                continue
+            if mask1 is None:
+                mask1 = self.get_mask()
+            if mask1.overlap(other.get_mask(), offset):
                 return True
         return False
 
 
+class SpatialHash:
+    """
+    Uniform grid over sprite positions used to find nearby sprites before testing collisions
+    """
+
+    def __init__(self, cell_size: int = 32, slack: int = 16):
+        self.cell_size = cell_size
+        self.slack = slack  # extra reach for sprites that move after the grid was built
+        self.cells: Dict[Tuple[int, int, int], List[Sprite]] = {}
+        self.extents: List[int] = [0] * S_NUM_TYPES
+
+    def rebuild(self, sprites: "SpriteStore") -> None:
+        """
+        Clears the grid and inserts every sprite from the given sprite store
+        """
+
+        self.cells.clear()
+        self.extents = [0] * S_NUM_TYPES
+        for sprite_type in sprites:
+            for sprite in sprite_type:
+                self.add(sprite)
+
+    def add(self, sprite: Sprite) -> None:
+        """
+        Inserts a single sprite into the cell its position falls in
+        """
+
+        cell = (sprite.sprite_type, floor(sprite.position[0] / self.cell_size),
+                floor(sprite.position[1] / self.cell_size))
+        if cell in self.cells:
+            self.cells[cell].append(sprite)
+        else:
+            self.cells[cell] = [sprite]
+        extent = max(sprite.costumes[sprite.costume].get_size())
+        if extent > self.extents[sprite.sprite_type]:
+            self.extents[sprite.sprite_type] = extent
+
+    def query(self, sprite: Sprite, *sprite_types: int) -> List[Sprite]:
+        """
+        Returns the sprites of the given types that are close enough to possibly collide with the given sprite
+        """
+
+        width, height = sprite.costumes[sprite.costume].get_size()
+        x, y = sprite.position
+        size = self.cell_size
+        nearby = []
+        for sprite_type in sprite_types:
+            reach = self.extents[sprite_type] + self.slack
+            for cell_x in range(floor((x - reach) / size), floor((x + width + self.slack) / size) + 1):
+                for cell_y in range(floor((y - reach) / size), floor((y + height + self.slack) / size) + 1):
+                    cell = self.cells.get((sprite_type, cell_x, cell_y))
+                    if cell:
+                        nearby += [other for other in cell if other is not sprite and not other.deleted]
+        return nearby
+
+
+class SpriteList:
+    """
+    Sprites of a single type in drawing order with constant time adding and removing; changes are only applied when
+    flush is called, so sprites can delete themselves and spawn others while the list is being looped over
+    """
+
+    def __init__(self):
+        self.front: Dict[Sprite, None] = {}  # sprites added to the front, drawn newest first
+        self.back: Dict[Sprite, None] = {}  # sprites added to the back, drawn oldest first
+        self.added: List[Tuple[Sprite, bool]] = []
+        self.removed: List[Sprite] = []
+
+    def __iter__(self) -> Iterator[Sprite]:
+        for sprite in reversed(self.front):
+            if not sprite.deleted:
+                yield sprite
+        for sprite in self.back:
+            if not sprite.deleted:
+                yield sprite
+
+    def __len__(self) -> int:
+        return len(self.front) + len(self.back)
+
+    def add(self, sprite: Sprite, front: bool = False) -> None:
+        self.added.append((sprite, front))
+
+    def remove(self, sprite: Sprite) -> None:
+        sprite.deleted = True
+        self.removed.append(sprite)
+
+    def flush(self) -> None:
+        """
+        Applies the sprites added and removed since the last flush
+        """
+
+        for sprite in self.removed:
+            if self.front.pop(sprite, self) is self:
+                self.back.pop(sprite, None)
+        self.removed.clear()
+        for sprite, front in self.added:
+            if not sprite.deleted:
+                (self.back, self.front)[front][sprite] = None
+        self.added.clear()
+
+    def clear(self) -> None:
+        self.front.clear()
+        self.back.clear()
+        self.added.clear()
+        self.removed.clear()
+
+
+class SpriteStore:
+    """
+    A sprite list for every sprite type, drawn and updated one type after another
+    """
+
+    def __init__(self):
+        self.types = [SpriteList() for _ in range(S_NUM_TYPES)]
+
+    def __getitem__(self, sprite_type: int) -> SpriteList:
+        return self.types[sprite_type]
+
+    def __iter__(self) -> Iterator[SpriteList]:
+        return iter(self.types)
+
+    def all(self) -> Iterator[Sprite]:
+        """
+        Iterates over every sprite in drawing order
+        """
+
+        return chain.from_iterable(self.types)
+
+    def add(self, sprite: Sprite, front: bool = False) -> None:
+        self.types[sprite.sprite_type].add(sprite, front)
+
+    def flush(self) -> None:
+        for sprite_type in self.types:
+            sprite_type.flush()
+
+    def clear(self) -> None:
+        for sprite_type in self.types:
+            sprite_type.clear()
+
+
 class Button:
     """
     Class for handling on screen buttons widgets
     """
 
     def __init__(self, use_font: font.Font, text: str,
-                 hover_sound: Optional[mixer.Sound] = None, click_sound: Optional[mixer.Sound] = None,
+                 hover_sound: Optional["SoundEffect"] = None, click_sound: Optional["SoundEffect"] = None,
                  animate: bool = True):
         self.font = use_font
         self.text = ""
@@ -417,7 +821,7 @@ class Button:
         else:
             trans = None
         self.text = text
-        text = self.font.render(text, False, Color("white"))
+        text = TextCache.render(self.font, text, Color("white"))
         size = Vector2(text.get_size()) + Vector2(5, 4)
         padding = 0
         if size[0] < 16:
@@ -439,23 +843,17 @@ class Button:
 
         self.position[0] = (RESOLUTION - self.img.get_width()) // 2
 
-    def update(self, quick_keys: UI, bar_mode: int, trans: bool, tabbed: bool = False,
-               only_widget: bool = False) -> bool:
+    def update(self, quick_keys: UI, bar_mode: int, tabbed: bool = False, only_widget: bool = False) -> bool:
         """
         Updates and returns if the button has been pressed
         """
 
         animate = self.animate and not (only_widget or IS_MOBILE)
-        mouse_p = mouse_pos(bar_mode)
+        mouse_p = mouse_pos(bar_mode, quick_keys.current[2])
         last_hover = self.hover
         hover_amount = Vector2(0, (1 + animate)) * (not IS_MOBILE)
-        if trans:
-            self.hover = False
-            if animate:
-                self.img.set_alpha(240)
-        else:
-            self.hover = (Rect(self.position - hover_amount + hover_amount * last_hover,
-                               Vector2(self.img.get_size()) + hover_amount).collidepoint(*mouse_p) or tabbed)
+        self.hover = (Rect(self.position - hover_amount + hover_amount * last_hover,
+                           Vector2(self.img.get_size()) + hover_amount).collidepoint(*mouse_p) or tabbed)
         if only_widget and (quick_keys.tapped("qEnter") or quick_keys.tapped("qEnter2")):
             if self.click_sound:
                 self.click_sound.play()
@@ -475,6 +873,18 @@ class Button:
             self.img.set_alpha((240, None)[self.hover])
         return False
 
+    def rest(self) -> None:
+        """
+        Puts the button back the way it looks when nothing is over it, without handling any user-input
+        """
+
+        animate = self.animate and not IS_MOBILE
+        if self.hover:
+            self.hover = False
+            self.position += Vector2(0, (1 + animate)) * (not IS_MOBILE)
+        if animate:
+            self.img.set_alpha(240)
+
     def get_image(self) -> Tuple[Surface, Vector2]:
         return self.img, self.position
 
@@ -509,18 +919,15 @@ class Slider:
 
         self.position[0] = (RESOLUTION - self.img.get_width()) // 2
 
-    def update(self, quick_keys: UI, bar_mode: int, tabbed: bool, trans: bool, sound: mixer.Sound = None) -> float:
+    def update(self, quick_keys: UI, bar_mode: int, tabbed: bool, sound: "SoundEffect" = None) -> float:
         """
         Updates and returns the value that the slider is put to
         """
 
-        mouse_p = mouse_pos(bar_mode)
+        mouse_p = mouse_pos(bar_mode, quick_keys.current[2])
         hover_amount = Vector2(0, 1)
-        if trans:
-            hover = False
-        else:
-            hover = (Rect(self.position - hover_amount + hover_amount * self.selected,
-                          Vector2(self.img.get_size()) + hover_amount).collidepoint(*mouse_p))
+        hover = (Rect(self.position - hover_amount + hover_amount * self.selected,
+                      Vector2(self.img.get_size()) + hover_amount).collidepoint(*mouse_p))
         last_selected = self.selected
         if (hover and quick_keys.tapped("Click")) or (tabbed and not self.selected):
             self.selected = True
@@ -544,6 +951,461 @@ class Slider:
         return self.img, self.position
 
 
+class SimulatedClock:
+    """
+    Stand-in for pygame's Clock that advances by a fixed amount every tick instead of following the wall clock
+    """
+
+    def __init__(self, framerate: int = TICK_RATE):
+        self.framerate = framerate
+        self.frames = 0
+        self.frame_time = 0
+        self.ticks = 0
+
+    def tick(self, _framerate: int = 0) -> int:
+        self.frames += 1
+        ticks = self.frames * 1000 // self.framerate  # whole milliseconds that add up exactly over time
+        self.frame_time = ticks - self.ticks
+        self.ticks = ticks
+        return self.frame_time
+
+    def get_time(self) -> int:
+        return self.frame_time
+
+
+class FramePacer:
+    """
+    Replacement for pygame's Clock that keeps frames due at a steady interval; most of the wait is slept through,
+    giving the time to the browser on the web, and the last moments are spun through as sleeping can overshoot
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.due = self.start  # when the current frame was due to start
+        self.frame_time = 0
+        self.ticks = 0
+        self.skipped = 0
+
+    async def tick(self, framerate: int = 0) -> int:
+        """
+        Waits until the next frame is due and returns the milliseconds since the last one started
+        """
+
+        if framerate:
+            self.due += 1 / framerate
+            now = perf_counter()
+            if now > self.due + MAX_FRAME_SKIP / framerate:  # too far behind to catch up, so start again from now
+                self.due = now
+            if IS_WEB:
+                await asyncio.sleep(max(self.due - now, 0))
+            else:
+                await asyncio.sleep(max(self.due - now - SLEEP_PRECISION, 0))
+                while perf_counter() < self.due:
+                    pass
+        else:
+            await asyncio.sleep(0)
+            self.due = perf_counter()
+        ticks = int((perf_counter() - self.start) * 1000)  # whole milliseconds so that timers add up exactly
+        self.frame_time = ticks - self.ticks
+        self.ticks = ticks
+        return self.frame_time
+
+    def behind(self, framerate: int) -> bool:
+        """
+        True when the next frame is already due, so this one should skip drawing to catch up; drawing is only ever
+        skipped for MAX_FRAME_SKIP frames in a row
+        """
+
+        if framerate and self.skipped < MAX_FRAME_SKIP and perf_counter() > self.due + 1 / framerate:
+            self.skipped += 1
+            return True
+        self.skipped = 0
+        return False
+
+    def get_time(self) -> int:
+        return self.frame_time
+
+
+class InputRecorder:
+    """
+    Records the user-input of every frame so that a session can be replayed exactly by an InputPlayer
+    """
+
+    def __init__(self, file: str, header: Dict[str, Any]):
+        self.file = file
+        self.lines = [json.dumps(header)]
+        self.last_time: Optional[int] = None
+        self.last_states: Optional[List[List[list]]] = None
+
+    def record(self, frame_time: int, uis: Sequence[UserInterface], key_events: List[Tuple[int, str]],
+               movement: Vector2) -> None:
+        """
+        Adds a frame to the recording, only storing what changed since the last frame
+        """
+
+        frame = {}
+        if frame_time != self.last_time:
+            frame["t"] = self.last_time = frame_time
+        states = [ui.get_state() for ui in uis]
+        if states != self.last_states:
+            frame["s"] = self.last_states = states
+        if key_events:
+            frame["k"] = key_events
+        if movement:
+            frame["m"] = movement[:]
+        self.lines.append(json.dumps(frame, separators=(",", ":")))
+
+    def save(self) -> None:
+        write(self.file, self.lines)
+
+
+class InputPlayer:
+    """
+    Plays back a session recorded by an InputRecorder one frame at a time
+    """
+
+    def __init__(self, file: str):
+        lines = [line for line in read(file) if line]
+        self.header: Dict[str, Any] = json.loads(lines[0])
+        self.frames = lines[1:]
+        self.index = 0
+        self.frame_time = 0
+        self.states: List[List[list]] = []
+        self.key_events: List[Tuple[int, str]] = []
+        self.movement = Vector2(0, 0)
+
+    def next(self) -> bool:
+        """
+        Moves on to the next recorded frame, returning False once the recording has ended
+        """
+
+        if self.index >= len(self.frames):
+            return False
+        frame = json.loads(self.frames[self.index])
+        self.index += 1
+        self.frame_time = frame.get("t", self.frame_time)
+        self.states = frame.get("s", self.states)
+        self.key_events = [(k, u) for k, u in frame.get("k", [])]
+        self.movement.update(frame.get("m", (0, 0)))
+        return True
+
+
+class PerformanceMonitor:
+    """
+    Times each phase of every frame, for the performance overlay and for logging to a CSV file
+    """
+
+    PHASES = ("input", "simulation", "world", "draw", "scale", "flip", "wait")
+
+    def __init__(self, visible: bool = False, csv_file: Optional[str] = None, history: int = 120):
+        self.visible = visible
+        self.history = {phase: deque(maxlen=history) for phase in self.PHASES + ("total",)}
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.started: List[Tuple[str, float]] = []
+        self.sprite_counts: List[int] = []
+        self.frame = 0
+        self.csv = None
+        if csv_file:
+            self.csv = open(csv_file, "w")
+            self.csv.write(",".join(("frame",) + self.PHASES + ("total",) + S_NAMES) + "\n")
+
+    @property
+    def enabled(self) -> bool:
+        return self.visible or self.csv is not None
+
+    def begin(self, phase: str) -> None:
+        """
+        Starts timing a phase; phases begun inside another phase are not counted towards the outer one
+        """
+
+        if self.enabled:
+            self.started.append((phase, perf_counter()))
+
+    def end(self) -> None:
+        """
+        Stops timing the most recently begun phase
+        """
+
+        if self.enabled and self.started:
+            phase, start = self.started.pop()
+            elapsed = (perf_counter() - start) * 1000
+            self.current[phase] += elapsed
+            if self.started:
+                self.current[self.started[-1][0]] -= elapsed
+
+    def end_frame(self, sprites: "SpriteStore") -> None:
+        """
+        Stores the timings of the frame that just finished and starts a new one
+        """
+
+        if not self.enabled:
+            return
+        self.frame += 1
+        total = sum(self.current.values())
+        for phase, elapsed in self.current.items():
+            self.history[phase].append(elapsed)
+        self.history["total"].append(total)
+        self.sprite_counts = [len(sprite_type) for sprite_type in sprites]
+        if self.csv is not None:
+            row = [self.frame] + [f"{self.current[phase]:.3f}" for phase in self.PHASES] + [f"{total:.3f}"]
+            self.csv.write(",".join(map(str, row + self.sprite_counts)) + "\n")
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+
+    def draw(self, screen: Surface, use_font: font.Font) -> None:
+        """
+        Blits the rolling median and 95th and 99th percentile of every phase and the sprite counts onto the screen
+        """
+
+        if not (self.visible and self.history["total"]):
+            return
+        lines = [f"{'ms':<10}{'p50':>6}{'p95':>6}{'p99':>6}"]
+        for phase, times in self.history.items():
+            lines.append(f"{phase:<10}" + "".join(f"{percentile(times, p):>6.2f}" for p in (50, 95, 99)))
+        lines += [f"{name:<10}{count:>6}" for name, count in zip(S_NAMES, self.sprite_counts) if count]
+        height = len(lines) * use_font.get_linesize() + 4
+        Overlay.dim(screen, 160, Rect(RESOLUTION - 150, RESOLUTION - height, 150, height))
+        render_text(use_font, "\n".join(lines), Color("white"), Vector2(RESOLUTION - 148, RESOLUTION - height + 2),
+                    screen)
+
+    def close(self) -> None:
+        if self.csv is not None:
+            self.csv.close()
+            self.csv = None
+
+
+class Overlay:
+
+    # opaque black surfaces shared by every fade and dimmed menu, keyed by size
+    surfaces: Dict[Tuple[int, int], Surface] = {}
+
+    @staticmethod
+    def dim(screen: Surface, alpha: float, rect: Optional[Rect] = None) -> None:
+        """
+        Darkens the screen, or the given part of it, by blitting black with the given alpha over it
+        """
+
+        if rect is None:
+            rect = screen.get_rect()
+        overlay = Overlay.surfaces.get(rect.size)
+        if overlay is None:
+            overlay = Overlay.surfaces[rect.size] = Surface(rect.size).convert_alpha()
+            overlay.fill(Color("black"))
+        overlay.set_alpha(alpha)
+        screen.blit(overlay, rect)
+
+
+class Assets:
+    """
+    Images converted to the display's pixel format and the named frames of the sprite sheet, shared by every sprite
+    """
+
+    def __init__(self, files: Dict[str, str]):
+        self.loaded = {name: image.load(file) for name, file in files.items()}
+        self.images: Dict[str, Surface] = dict(self.loaded)
+        self.frames: Dict[str, Tuple[Surface, ...]] = {}
+        self.display_format = None
+        self.cut_frames()
+
+    def cut_frames(self) -> None:
+        sheet = self.images["sprites"]
+        self.frames = {name: tuple(sheet.subsurface(rect) for rect in rects) for name, rects in SPRITE_FRAMES.items()}
+
+    def convert(self) -> bool:
+        """
+        Converts every image to the display's pixel format and cuts the frames out of the converted sprite sheet again,
+        unless the pixel format is the same as last time; returns whether anything was converted
+        """
+
+        surface = display.get_surface()
+        display_format = (surface.get_bitsize(), surface.get_masks())
+        if display_format == self.display_format:
+            return False
+        self.display_format = display_format
+        for name, loaded in self.loaded.items():
+            if loaded.get_flags() & SRCALPHA:
+                self.images[name] = loaded.convert_alpha()
+            else:
+                self.images[name] = loaded.convert()
+        self.cut_frames()
+        return True
+
+
+class LazyDict(dict):
+    """
+    Dictionary of things loaded from files the first time they are asked for, or ahead of time one at a time
+    """
+
+    def __init__(self, load: Callable[[str], Any], files: Dict[str, str]):
+        super().__init__()
+        self.load = load
+        self.files = dict(files)  # names and files of everything not loaded yet
+
+    def __missing__(self, name: str) -> Any:
+        value = self[name] = self.load(self.files.pop(name))
+        return value
+
+    def preload(self) -> bool:
+        """
+        Loads the next thing that hasn't been loaded yet and returns whether anything is left to load
+        """
+
+        if self.files:
+            self.__missing__(next(iter(self.files)))
+        return bool(self.files)
+
+
+class SoundEffect:
+    """
+    A sound effect that is played through SoundEffects, so it can be given to widgets like a Sound
+    """
+
+    def __init__(self, effects: "SoundEffects", name: str):
+        self.effects = effects
+        self.name = name
+
+    def play(self) -> None:
+        self.effects.play(self.name)
+
+
+class SoundEffects:
+    """
+    Plays sound effects on the mixer channels set aside for their kind, so a burst of one kind can't cut off the
+    others; the same sound only starts once a frame, and only MAX_VOICES copies of it play at the same time
+    """
+
+    def __init__(self, files: Dict[str, str], volume: float):
+        self.sounds = LazyDict(self.load, files)
+        self.volume = volume
+        self.started: Set[str] = set()  # sounds started since the last frame
+        reserved = sum(SOUND_CHANNELS.values())
+        mixer.set_num_channels(max(mixer.get_num_channels(), reserved))
+        mixer.set_reserved(reserved)  # so that nothing else plays on these channels
+        # the channels of each kind and the sound each of them last played
+        self.pools: Dict[str, List[List[Union[mixer.Channel, str]]]] = {}
+        first = 0
+        for kind, count in SOUND_CHANNELS.items():
+            self.pools[kind] = [[mixer.Channel(i), ""] for i in range(first, first + count)]
+            first += count
+        self.effects = {name: SoundEffect(self, name) for name in SOUND_KINDS}
+
+    def __getitem__(self, name: str) -> SoundEffect:
+        return self.effects[name]
+
+    def load(self, file: str) -> mixer.Sound:
+        sound = load_sound(file)
+        sound.set_volume(self.volume)
+        return sound
+
+    def play(self, name: str) -> None:
+        """
+        Starts a sound effect on a free channel of its kind, unless it can't be heard over what's already playing
+        """
+
+        if name in self.started:
+            return
+        free = None
+        voices = 0
+        for voice in self.pools[SOUND_KINDS[name]]:
+            if voice[0].get_busy():
+                voices += voice[1] == name
+            elif free is None:
+                free = voice
+        if free is not None and voices < MAX_VOICES:
+            self.started.add(name)
+            free[0].play(self.sounds[name])
+            free[1] = name
+
+    def update(self, volume: float) -> None:
+        """
+        Starts a new frame, changing the volume of the sound effects only when it was changed
+        """
+
+        self.started.clear()
+        if volume != self.volume:
+            self.volume = volume
+            for sound in self.sounds.values():
+                sound.set_volume(volume)
+
+    def preload(self) -> bool:
+        return self.sounds.preload()
+
+
+class Leaderboard:
+    """
+    High scores loaded once and kept sorted from highest to lowest, only written back to disk when a name is entered
+    """
+
+    def __init__(self, file: Optional[str], size: int = LEADERBOARD_SIZE):
+        self.file = file
+        self.size = size
+        self.lines: List[str] = []  # the "NAME:score" rows shown on the leaderboard screen
+        self.keys: List[int] = []  # negated scores, ascending so they can be bisected
+        if file is not None:
+            for line in read(file):
+                name, _, entry_score = line.rpartition(":")
+                if entry_score.lstrip("-").isdecimal():
+                    self.insert(name, int(entry_score))
+
+    def get_position(self, score: int) -> Optional[int]:
+        """
+        Returns where the given score would go on the leaderboard, below any equal scores, or None if it is too low
+        """
+
+        position = bisect_right(self.keys, -score)
+        if position < self.size:
+            return position
+
+    def insert(self, name: str, score: int) -> Optional[int]:
+        """
+        Adds a score to the leaderboard, dropping the lowest score if it is full, and returns where it went
+        """
+
+        position = self.get_position(score)
+        if position is not None:
+            self.keys.insert(position, -score)
+            self.lines.insert(position, f"{name}:{score}")
+            del self.keys[self.size:], self.lines[self.size:]
+        return position
+
+    def save(self) -> None:
+        if self.file is not None:
+            write(self.file, self.lines + [""])
+
+    def get_rows(self, score: Optional[int] = None, name: str = "") -> List[str]:
+        """
+        Returns the rows to show on screen, including the given score being named at its position if there is one
+        """
+
+        position = None if score is None else self.get_position(score)
+        if position is None:
+            return self.lines[:LEADERBOARD_ROWS]
+        start = max(0, position - LEADERBOARD_ROWS + 1)
+        rows = self.lines[start:position] + [f"{name}:{score}"] + self.lines[position:]
+        return rows[:LEADERBOARD_ROWS]
+
+
+class TextCache:
+
+    # rendered lines of text keyed by font, text and colour, oldest use first
+    lines: "OrderedDict[Tuple[font.Font, str, Tuple[int, ...]], Surface]" = OrderedDict()
+
+    @staticmethod
+    def render(use_font: font.Font, text: str, font_color: Color) -> Surface:
+        """
+        Returns the given line of text rendered in the given font and colour, only rendering it when it isn't cached
+        """
+
+        line_key = (use_font, text, tuple(font_color))
+        image = TextCache.lines.get(line_key)
+        if image is None:
+            image = TextCache.lines[line_key] = use_font.render(text, False, font_color)
+            if len(TextCache.lines) > TEXT_CACHE_SIZE:
+                TextCache.lines.popitem(last=False)
+        else:
+            TextCache.lines.move_to_end(line_key)
+        return image
+
+
 def read(file: str, binary: bool = False) -> Union[List[str], Dict[str, str]]:
     """
     Quick and easy function for reading from a file
@@ -576,6 +1438,51 @@ def write(file: str, contents: Union[List[str], bytes], binary: bool = False) ->
             f.writelines('\n'.join(contents))
 
 
+def load_sound(file: str) -> mixer.Sound:
+    """
+    Loads a sound effect, only decoding it the first time and afterwards reading its raw samples from SOUND_CACHE
+    """
+
+    mixer_format = mixer.get_init()
+    if mixer_format is None:
+        return mixer.Sound(file)
+    name = os.path.splitext(os.path.basename(file))[0]
+    cache = os.path.join(SOUND_CACHE, f"{name} {' '.join(map(str, mixer_format))}.pcm")
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(file):
+            return mixer.Sound(buffer=read(cache, True))
+    except OSError:
+        pass
+    sound = mixer.Sound(file)
+    try:
+        os.makedirs(SOUND_CACHE, exist_ok=True)
+        # written under another name first, so that a write cut short never leaves a cache that looks up to date
+        write(f"{cache}.tmp", sound.get_raw(), True)
+        os.replace(f"{cache}.tmp", cache)
+    except OSError:  # e.g. a read only file system, the sound just gets decoded again next time
+        pass
+    return sound
+
+
+def get_peak_memory() -> Optional[float]:
+    """
+    Returns the most memory in megabytes the process has had resident so far, if the platform can tell
+    """
+
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """
+    Returns the value below which the given percentage of the values fall
+    """
+
+    values = sorted(values)
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
 def v_mul(*vectors: Vector2) -> Vector2:
     """
     Multiplies together all the x and y values of the given vectors
@@ -595,16 +1502,18 @@ def render_text(use_font: font.Font, text: str, font_color: Color = Color("black
     """
     write_position = Vector2(position)
     for line in text.split("\n"):
-        render = use_font.render(line, False, font_color)
+        # numbers like the score are cached whole too, as composing them from digits would lose the font's kerning
+        render = TextCache.render(use_font, line, font_color)
+        width, height = render.get_size()
         if center:
-            write_position[0] = (RESOLUTION - render.get_width()) // 2
+            write_position[0] = (RESOLUTION - width) // 2
         if on_right:
-            write_position[0] -= render.get_width()
+            write_position[0] -= width
         screen.blit(render, write_position)
-        write_position[0] += render.get_width()
+        write_position[0] += width
         if not center:
             write_position[0] = position[0]
-        write_position[1] += render.get_height()
+        write_position[1] += height
     return screen
 
 
@@ -627,14 +1536,16 @@ def get_game_screen(bar_mode, size_override: Optional[Sequence[float]] = None) -
         return Rect((size[0] - size[1]) / 2, 0, size[1], size[1])
 
 
-def mouse_pos(bar_mode: int) -> Vector2:
+def mouse_pos(bar_mode: int, position: Optional[Sequence[int]] = None) -> Vector2:
     """
-    Returns the mouse position converted into in game units
+    Returns the mouse position, or the given position on the window, converted into in game units
     """
 
+    if position is None:
+        position = mouse.get_pos()
     game_screen = get_game_screen(bar_mode)
     scale = Vector2(RESOLUTION / game_screen.size[0], RESOLUTION / game_screen.size[1])
-    mouse_p = v_mul(Vector2(mouse.get_pos()) - Vector2(game_screen.topleft), scale)
+    mouse_p = v_mul(Vector2(position) - Vector2(game_screen.topleft), scale)
     return mouse_p
 
 
@@ -643,7 +1554,35 @@ def get_desktop_size() -> Vector2:
     return Vector2(sizes[0])
 
 
-async def main() -> None:
+async def main(headless: bool = False, frames: int = 0, levels: int = 0, render: bool = True,
+               seed: Optional[int] = None, record: Optional[str] = None, replay: Optional[str] = None,
+               benchmark: Optional[Callable[[SimpleNamespace], Any]] = None, hud: bool = False,
+               hud_csv: Optional[str] = None, framerate: int = FRAMERATE) -> Any:
+    """
+    Runs the game; when headless the play loop runs without a window as fast as possible until the given number of
+    frames or levels has been simulated, and the simulation speed is returned; nobody steers when levels are simulated
+    without a replay, so the player can't crash then.
+    A seed makes the world and the ducks' behaviour repeatable, record saves every frame of user-input to a file
+    and replay plays such a file back instead of reading the user's devices.
+    The performance overlay (toggled with F3) starts shown when hud is set, and hud_csv logs the same numbers per frame.
+    A benchmark is called with the game's internals once everything is loaded, instead of running the game loop.
+    The window is drawn at the given frame rate
+    """
+
+    load_start = perf_counter()
+    player = None
+    if replay:
+        player = InputPlayer(replay)
+        seed = player.header["seed"]
+    elif record and seed is None:
+        seed = Random().randrange(2 ** 32)
+    immortal = headless and bool(levels) and player is None  # otherwise the unsteered player never finishes a level
+    world_random = Random(None if seed is None else f"{seed}/world")
+    behaviour_random = Random(None if seed is None else f"{seed}/behaviour")
+
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
     init()
     key.stop_text_input()
 
@@ -652,33 +1591,50 @@ async def main() -> None:
     use_font = font.Font(FONT_MAIN, 14)
     score_font = font.Font(FONT_SCORE, 40)
     score_font_big = font.Font(FONT_SCORE, 48)
-    start_screen = image.load(SCREEN_START)
-    end_screen = image.load(SCREEN_END)
-    splash = image.load(SPLASH)
-    sprite_sheet = image.load(SHEET_SPRITE)
-    ui_sheet = image.load(SHEET_UI)
-    mobile_sheet = ui_sheet.subsurface(32, 16, 16, 16)
-    mobile_sheet = (mobile_sheet, transform.flip(mobile_sheet, True, False),
-                    transform.scale(ui_sheet.subsurface(48, 16, 16, 16), (32, 32)))
-    music = mixer.Sound(SOUND_MUSIC)
-    sfx = {f.split('.')[0].split('/')[-1]: mixer.Sound(f) for f in SOUND_SFX}
+    assets = Assets({"start": SCREEN_START, "end": SCREEN_END, "splash": SPLASH, "sprites": SHEET_SPRITE,
+                     "ui": SHEET_UI})
+    start_screen, end_screen, splash, ui_sheet = Surface((0, 0)), Surface((0, 0)), Surface((0, 0)), Surface((0, 0))
+    mobile_sheet: Tuple[Surface, ...] = ()
+    leaderboard = Leaderboard(LEADERBOARD)
+    mixer.music.load(SOUND_MUSIC)  # streamed while it plays instead of being decoded into memory up front
+    volume_music, volume_effect = 25, 50
+    sfx = SoundEffects({f.split('.')[0].split('/')[-1]: f for f in SOUND_SFX}, volume_effect / 100)
+
+    def use_assets() -> None:
+        """
+        Picks up the images of the assets, after they were converted to the display's pixel format
+        """
+
+        nonlocal start_screen, end_screen, splash, ui_sheet, mobile_sheet
+
+        start_screen, end_screen, splash, ui_sheet = (assets.images[i] for i in ("start", "end", "splash", "ui"))
+        mobile_sheet = ui_sheet.subsurface(32, 16, 16, 16)
+        mobile_sheet = (mobile_sheet, transform.flip(mobile_sheet, True, False),
+                        transform.scale(ui_sheet.subsurface(48, 16, 16, 16), (32, 32)))
+
+    use_assets()
 
     # initialize display
     def reset_screen() -> None:
-        nonlocal screen, screen_full
+        nonlocal screen, screen_full, last_frame
 
+        last_frame = None
         display.quit()
         if IS_MOBILE:
             screen = display.set_mode(screen_size, FULLSCREEN)
         else:
             screen = display.set_mode(screen_size, RESIZABLE)
             screen_full = False
-        display.set_icon(sprite_sheet.subsurface(48, 128, 16, 16))
+        event.set_blocked(IGNORED_EVENTS)  # so they don't have to be drained from the queue every frame
+        if assets.convert():
+            use_assets()
+        display.set_icon(assets.frames["icon"][0])
         display.set_caption("Roboduck")
 
     def fullscreen() -> None:
-        nonlocal screen, screen_full, screen_size
+        nonlocal screen, screen_full, screen_size, last_frame
 
+        last_frame = None
         if not IS_WEB:
             screen_full = not screen_full
             if screen_full:
@@ -698,42 +1654,118 @@ async def main() -> None:
                 display.set_mode(screen_size)
                 display.set_mode(screen_size, RESIZABLE)
 
-    def trans(blit: bool, to: str, trans_time: int, backward: bool = False) -> None:
-        nonlocal mode, old_mode, new_mode, transition1, transition2, trans_dir, anim_timer, total_time
-
-        if blit:
-            old_mode = mode
-            new_mode = to
-            transition1 = update(False)
-            mode = to
-            transition2 = update(False)
-            mode = "transition"
-            anim_timer = trans_time
-            total_time = trans_time
-            if backward:
-                trans_dir = -1
+    def trans(to: str, trans_time: int, backward: bool = False) -> None:
+        nonlocal mode, old_mode, new_mode, transition, trans_dir, anim_timer, total_time
+
+        old_mode = mode
+        new_mode = to
+        if transition is None:
+            transition = Surface((RESOLUTION * 2, RESOLUTION)).convert_alpha()
+        transition.fill((0, 0, 0, 0))
+        # the screen slides in from the right when going forward, so the old one is on the left of the strip
+        for i, menu in enumerate((mode, to)[::1 - 2 * backward]):
+            # copies the pixels as they are instead of blending them onto the empty strip
+            transition.blit(snapshot(menu), (i * RESOLUTION, 0), special_flags=BLEND_RGBA_MAX)
+        mode = "transition"
+        anim_timer = trans_time
+        total_time = trans_time
+        if backward:
+            trans_dir = -1
+        else:
+            trans_dir = 1
+
+    def refresh_widgets(menu: str) -> None:
+        """
+        Brings the images of a menu's widgets up to date with the options they show
+        """
+
+        if menu == "display":
+            widgets[2][0].set_image(assets.frames["bar modes"][bar_mode])
+            widgets_draw[2][0] = widgets[2][0].get_image()
+        elif menu == "keybinds" and not IS_MOBILE:
+            for i, k in enumerate(list(ui.key_binds.keys())[QUICK_KEYBINDS:]):
+                if i != keybind_selected or keybind_select == 0:
+                    i += 1
+                    bind_img = ui.get_image(k, use_font)
+                    if widgets[4][i].img is not bind_img:
+                        widgets[4][i].set_image(bind_img)
+                        widgets_draw[4][i] = widgets[4][i].get_image()
+
+    def draw_menu(menu: str, surf: Surface) -> None:
+        """
+        Draws everything on a menu screen that goes under its widgets
+        """
+
+        if menu == "start":
+            render_text(score_font_big, "Roboduck", Color("dark blue"), Vector2(0, 0), surf, True)
+        elif menu == "display":
+            text = ("No", "Horizontal", "Vertical", "Both")[bar_mode] + " Bars"
+            render_text(use_font, text, Color("dark blue"), Vector2(140, 73), surf, on_right=True)
+        elif menu == "sound":
+            render_text(use_font, "Music", Color("dark blue"), Vector2(80, 80), surf)
+            render_text(use_font, "Sound", Color("dark blue"), Vector2(80, 100), surf)
+        elif menu == "keybinds":
+            if IS_MOBILE:
+                render_text(use_font, "Mobile instructions", Color("dark blue"), Vector2(8, 0), surf, center=True)
             else:
-                trans_dir = 1
+                for i, k in enumerate(list(ui.key_binds.keys())[QUICK_KEYBINDS:]):
+                    render_text(use_font, k, Color("dark blue"), Vector2(100, RESOLUTION // 2 - 86 + i * 20), surf)
+        elif menu == "help":
+            surf.fill(Color("grey 25"))
+            render_text(use_font, HELP_TEXT, Color("white"), Vector2(0, 0), surf, center=True)
+
+    def get_menu_widgets(menu: str) -> List[Tuple[Surface, Vector2]]:
+        """
+        Returns the images and positions of the widgets drawn on a menu screen
+        """
+
+        if menu == "keybinds" and IS_MOBILE:
+            return widgets_draw[4][-1:]
+        return widgets_draw[MENU_WIDGETS[menu]]
 
-    def update(blit: bool = True) -> Surface:
-        nonlocal mode, anim_timer, score_timer, last_score, score_i, pause, score_name, leaderboard_timer
+    def snapshot(menu: str) -> Surface:
+        """
+        Returns an image of a menu screen with its buttons at rest, only drawing it again when what it shows changed
+        """
+
+        for widget in widgets[MENU_WIDGETS[menu]]:
+            if isinstance(widget, Button):
+                widget.rest()
+        refresh_widgets(menu)
+        menu_widgets = get_menu_widgets(menu)
+        content = (tuple((img, img.get_alpha(), tuple(position)) for img, position in menu_widgets),
+                   tuple(widget.value for widget in widgets[MENU_WIDGETS[menu]] if isinstance(widget, Slider)),
+                   bar_mode, ui)
+        cached = snapshots.get(menu)
+        if cached is not None and cached[0] == content:
+            return cached[1]
+        if cached is None:
+            surf = Surface((RESOLUTION, RESOLUTION)).convert_alpha()
+        else:
+            surf = cached[1]
+        surf.fill((0, 0, 0, 0))
+        draw_menu(menu, surf)
+        surf.blits(menu_widgets)
+        snapshots[menu] = (content, surf)
+        return surf
+
+    def update() -> None:
+        nonlocal mode, anim_timer, last_score, score_i, pause, score_name, leaderboard_timer
         nonlocal tabbed_widget, bar_mode, volume_music, volume_effect, keybind_select, keybind_selected, last_size
         nonlocal level, sprites, player_y, player_last_y, player_speed, duck_speed
-        nonlocal transition1, transition2, trans_dir, total_time, old_mode, background, last_aim
+        nonlocal trans_dir, total_time, old_mode, background, last_aim
 
-        if not (IS_MOBILE and mode == "play"):
-            screen.fill(Color("black"))
-        game_surf = Surface((RESOLUTION, RESOLUTION)).convert_alpha()
+        drawn_mode = mode  # the widgets may change the mode, but the frame still shows this one
+        game_surf = game_layer
         game_surf.fill((0, 0, 0, 0))
         game_screen = get_game_screen(bar_mode)
         if mode == "logo":
-            background = Surface((RESOLUTION, RESOLUTION))
-            background.fill(Color("black"))
+            background = logo_background
         else:
-            background = start_screen.copy()
+            background = start_screen
         if mode == "logo":
             grey = None
-            anim_timer -= clock.get_time()
+            anim_timer -= frame_time
             if anim_timer <= 0:
                 mode = "start"
                 anim_timer = 1000
@@ -746,29 +1778,27 @@ async def main() -> None:
                 render_text(splash_font, f"(ɔ) 2023, Evil Fish Co. All rights reserved.\nTEST{name}",
                             Color("white"), Vector2(0, 176), game_surf, True)
                 if anim_timer <= 2000:
-                    grey = game_surf.copy()
-                    grey.fill(Color("black"))
-                    grey.set_alpha((2000 - anim_timer) * 255 // 2000)
+                    grey = (2000 - anim_timer) * 255 // 2000
             else:
                 splash.set_alpha((5000 - anim_timer) * 255 // 2000)
             game_surf.blit(splash, (64, 32))
             if grey is not None:
-                game_surf.blit(grey, (0, 0))
+                Overlay.dim(game_surf, grey)
         if mode == "transition":
             anim_x = anim_timer / total_time * RESOLUTION * trans_dir
-            anim_timer -= clock.get_time()
+            anim_timer -= frame_time
             if anim_timer < 0:
                 mode = new_mode
                 if mode in ("options", "help"):
                     old_mode = "start"
-            game_surf.blit(transition1, (anim_x - RESOLUTION * trans_dir, 0))
-            game_surf.blit(transition2, (anim_x, 0))
+            game_surf.blit(transition, (0, 0), Rect(RESOLUTION * (trans_dir == 1) - int(anim_x), 0,
+                                                    RESOLUTION, RESOLUTION))
         elif mode == "start":
-            render_text(score_font_big, "Roboduck", Color("dark blue"), Vector2(0, 0), game_surf, True)
+            draw_menu(mode, game_surf)
             if anim_timer <= 0:
                 handle_tabs(len(widgets[0]))
                 for i, widget in enumerate(widgets[0]):
-                    if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                    if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                         tabbed_widget = None
                         if widget.text.lower() == "play":
                             mode = "play"
@@ -776,18 +1806,15 @@ async def main() -> None:
                         elif widget.text.lower() == "quit":
                             mode = "quit"
                         else:
-                            trans(blit, widget.text.lower(), MENU_TRANSITION_TIME)
+                            trans(widget.text.lower(), MENU_TRANSITION_TIME)
             game_surf.blits(widgets_draw[0])
             if mode != "transition" and anim_timer > 0:
-                anim_timer -= clock.get_time()
-                grey = game_surf.copy()
-                grey.fill(Color("black"))
-                grey.set_alpha(anim_timer * 255 // 1000)
-                game_surf.blit(grey, (0, 0))
+                anim_timer -= frame_time
+                Overlay.dim(game_surf, anim_timer * 255 // 1000)
         elif mode == "play":
             game_surf.fill(Color(("dark green", "dark blue", GREY_GREEN)[level - 1]))
-            for i in sum(sprites, []):
-                i.draw(game_surf, pause, player_sprite, player_speed[1], last_aim, ui, bar_mode,
+            for i in sprites.all():
+                i.draw(game_surf, player_sprite, player_speed[1], last_aim, ui, bar_mode,
                        level, pause)
             top_left = Vector2(-game_screen.left * RESOLUTION / game_screen.size[1],
                                -game_screen.top * RESOLUTION / game_screen.size[0])
@@ -836,9 +1863,7 @@ async def main() -> None:
                         score_i = 1 - i
                         break
                 last_score = score
-            if score_timer > 0:
-                score_timer -= clock.get_time()
-            else:
+            if score_timer <= 0:
                 score_i = 0
             if score_i == 0:
                 text1 = str(score)
@@ -853,18 +1878,12 @@ async def main() -> None:
                         game_surf)
             if player_sprite.timer is not None:
                 pause = False
-                grey = game_surf.copy()
-                grey.fill(Color("black"))
-                grey.set_alpha(255 - player_sprite.timer * (255 / 1000))
-                game_surf.blit(grey, (0, 0))
+                Overlay.dim(game_surf, 255 - player_sprite.timer * (255 / 1000))
             elif pause:
-                grey = game_surf.copy()
-                grey.fill(Color("black"))
-                grey.set_alpha(127)
-                game_surf.blit(grey, (0, 0))
+                Overlay.dim(game_surf, 127)
                 handle_tabs(len(widgets[5]))
                 for i, widget in enumerate(widgets[5]):
-                    if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                    if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                         if widget.text == "Main Menu":
                             mode = "start"
                             pause = False
@@ -876,11 +1895,8 @@ async def main() -> None:
         elif mode == "leaderboard":
             if score_name is not None:
                 pause = True
-            grey = game_surf.copy()
-            grey.fill(Color("black"))
-            grey.set_alpha(127)
-            game_surf.blit(grey, (0, 0))
-            text = read(LEADERBOARD)
+            Overlay.dim(game_surf, 127)
+            text = leaderboard.get_rows()
             if pause:
                 button_text = ("Continue", "Back")[score_name is None]
                 if widgets[6][0].text != button_text:
@@ -895,13 +1911,11 @@ async def main() -> None:
                         anim_timer = 0
                         underscore = ""
                     else:
-                        anim_timer += clock.get_time()
+                        anim_timer += frame_time
                         anim_timer %= 2000
                         underscore = "_ "[anim_timer // 1000]
-                    text.insert(get_leaderboard_position(), f"{score_name}{underscore}:{score}")
-                    if len(text) > 5:
-                        text = text[:5] + [""]
-                if widgets[6][0].update(quick_keys, bar_mode, not blit, only_widget=True):
+                    text = leaderboard.get_rows(score, f"{score_name}{underscore}")
+                if widgets[6][0].update(quick_keys, bar_mode, only_widget=True):
                     if score_name is None:
                         mode = "play"
                     else:
@@ -913,8 +1927,8 @@ async def main() -> None:
                     tabbed_widget = None
                     if score_name is not None:
                         if score_name != "":
-                            text[get_leaderboard_position()] = f"{score_name}:{score}"
-                            write(LEADERBOARD, text)
+                            leaderboard.insert(score_name, score)
+                            leaderboard.save()
                         score_name = None
                         pause = False
             elif ui.any(event_keyboard, movement):
@@ -923,7 +1937,7 @@ async def main() -> None:
             text = "\n".join(["LEADERBOARD"] + text)
             render_text(use_font, text, Color("gold"), Vector2(0, 32), game_surf, True)
         elif mode == "levelup":
-            if widgets[6][0].update(quick_keys, bar_mode, not blit, only_widget=True):
+            if widgets[6][0].update(quick_keys, bar_mode, only_widget=True):
                 tabbed_widget = None
                 if level > len(level_lengths):
                     if get_leaderboard_position() is not None:
@@ -944,10 +1958,10 @@ async def main() -> None:
         elif mode == "gameover":
             win_or_lose = level > len(level_lengths)
             game_surf.blit((end_screen, start_screen)[win_or_lose], (0, 0))
-            if widgets[7][0].update(quick_keys, bar_mode, not blit):
+            if widgets[7][0].update(quick_keys, bar_mode):
                 mode = "play"
                 reset_game()
-            elif widgets[7][1].update(quick_keys, bar_mode, not blit):
+            elif widgets[7][1].update(quick_keys, bar_mode):
                 mode = "start"
             if mode != "gameover":
                 tabbed_widget = None
@@ -960,23 +1974,21 @@ async def main() -> None:
         elif mode == "options":
             handle_tabs(len(widgets[1]))
             for i, widget in enumerate(widgets[1]):
-                if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                     tabbed_widget = None
                     if IS_MOBILE and widget.text.lower() == "display":
                         sfx["error"].play()
                     elif widget.text.lower() == "back":
-                        trans(blit, old_mode, MENU_TRANSITION_TIME, True)
+                        trans(old_mode, MENU_TRANSITION_TIME, True)
                     else:
-                        trans(blit, widget.text.lower(), MENU_TRANSITION_TIME)
+                        trans(widget.text.lower(), MENU_TRANSITION_TIME)
             game_surf.blits(widgets_draw[1])
         elif mode == "display":
-            text = ("No", "Horizontal", "Vertical", "Both")[bar_mode] + " Bars"
-            render_text(use_font, text, Color("dark blue"), Vector2(140, 73), game_surf, on_right=True)
-            widgets[2][0].set_image(sprite_sheet.subsurface(bar_mode * 16, 144, 16, 16))
-            widgets_draw[2][0] = widgets[2][0].get_image()
+            draw_menu(mode, game_surf)
+            refresh_widgets(mode)
             handle_tabs(len(widgets[2]))
             for i, widget in enumerate(widgets[2]):
-                if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                     if widget.text == "":
                         bar_mode = (bar_mode + 1) % 4
                     elif widget.text == "Fullscreen":
@@ -986,53 +1998,46 @@ async def main() -> None:
                         reset_screen()
                     elif widget.text == "Back":
                         tabbed_widget = None
-                        trans(blit, old_mode, MENU_TRANSITION_TIME, True)
+                        trans(old_mode, MENU_TRANSITION_TIME, True)
             game_surf.blits(widgets_draw[2])
         elif mode == "sound":
-            render_text(use_font, "Music", Color("dark blue"), Vector2(80, 80), game_surf)
-            render_text(use_font, "Sound", Color("dark blue"), Vector2(80, 100), game_surf)
+            draw_menu(mode, game_surf)
             handle_tabs(len(widgets[3]))
             for i, widget in enumerate(widgets[3]):
-                if isinstance(widget, Button) and widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                if isinstance(widget, Button) and widget.update(quick_keys, bar_mode, tabbed_widget == i):
                     if widget.text == "Reset":
                         for j, k in enumerate((0.25, 0.50)):
                             widgets[3][j].value = k
                             widgets[3][j].update_image()
                     elif widget.text == "Back":
                         tabbed_widget = None
-                        trans(blit, old_mode, MENU_TRANSITION_TIME, True)
+                        trans(old_mode, MENU_TRANSITION_TIME, True)
                 elif isinstance(widget, Slider):
-                    widget.update(quick_keys, bar_mode, tabbed_widget == i, not blit, w_sfx)
+                    widget.update(quick_keys, bar_mode, tabbed_widget == i, w_sfx)
                     if i == 0:
                         volume_music = widget.value * 100
                     elif i == 1:
                         volume_effect = widget.value * 100
             game_surf.blits(widgets_draw[3])
         elif mode == "keybinds":
+            draw_menu(mode, game_surf)
+            refresh_widgets(mode)
             if IS_MOBILE:
-                render_text(use_font, "Mobile instructions", Color("dark blue"),
-                            Vector2(8, 0), game_surf, center=True)
-                if widgets[4][-1].update(quick_keys, bar_mode, not blit, only_widget=True):
+                if widgets[4][-1].update(quick_keys, bar_mode, only_widget=True):
                     tabbed_widget = None
-                    trans(blit, old_mode, MENU_TRANSITION_TIME, True)
+                    trans(old_mode, MENU_TRANSITION_TIME, True)
                 game_surf.blit(*widgets_draw[4][-1])
             else:
-                for i, k in enumerate(list(ui.key_binds.keys())[QUICK_KEYBINDS:]):
-                    render_text(use_font, k, Color("dark blue"), Vector2(100, RESOLUTION // 2 - 86 + i * 20), game_surf)
-                    if i != keybind_selected or keybind_select == 0:
-                        i += 1
-                        widgets[4][i].set_image(ui.get_image(k, use_font))
-                        widgets_draw[4][i] = widgets[4][i].get_image()
                 handle_tabs(len(widgets[4]))
                 for i, widget in enumerate(widgets[4]):
-                    if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                    if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                         if widget.text == "Reset":
-                            write(KEY_BINDS, read(KEY_BIND_DEFAULT))
+                            DeviceDatabase.reset_binds(KEY_BINDS, KEY_BIND_DEFAULT)
                             ui.load(KEY_BINDS)
                             keybind_select, keybind_selected = 0, 0
                         elif widget.text == "Back":
                             tabbed_widget = None
-                            trans(blit, old_mode, MENU_TRANSITION_TIME, True)
+                            trans(old_mode, MENU_TRANSITION_TIME, True)
                             ui.save(KEY_BINDS)
                             keybind_select, keybind_selected = 0, 0
                         elif widget.text != "":
@@ -1060,31 +2065,112 @@ async def main() -> None:
                             keybind_selected = i - 1
                 game_surf.blits(widgets_draw[4])
         elif mode == "help":
-            game_surf.fill(Color("grey 25"))
-            render_text(use_font, "Throw bread at ducks to earn points\n"
-                                  "while also dodging everything\nthat's in your way.\n"
-                                  "If you can hit the same duck twice\nyou get three points from it.\n"
-                                  "Collect loaves off the floor for\nmore bread to throw.\n"
-                                  "Rare bread cannons can be used to\nfeed all ducks on screen\nat the same time.\n"
-                                  "Most importantly, have fun!",
-                        Color("white"), Vector2(0, 0), game_surf, center=True)
+            draw_menu(mode, game_surf)
             game_surf.blits(widgets_draw[8])
             handle_tabs(len(widgets[8]))
             for i, widget in enumerate(widgets[8]):
-                if widget.update(quick_keys, bar_mode, not blit, tabbed_widget == i):
+                if widget.update(quick_keys, bar_mode, tabbed_widget == i):
                     tabbed_widget = None
                     if widget.text == "Keybinds":
-                        trans(blit, "keybinds", MENU_TRANSITION_TIME)
+                        trans("keybinds", MENU_TRANSITION_TIME)
                     elif widget.text == "Back":
-                        trans(blit, old_mode, MENU_TRANSITION_TIME, True)
-        if blit:
-            screen.blit(transform.scale(background, game_screen.size), game_screen.topleft)
-            screen.blit(transform.scale(game_surf, game_screen.size), game_screen.topleft)
+                        trans(old_mode, MENU_TRANSITION_TIME, True)
+        monitor.draw(game_surf, splash_font)
+        present(game_surf, game_screen, drawn_mode)
+
+    def present(game_surf: Surface, game_screen: Rect, drawn_mode: str) -> None:
+        """
+        Scales the background and the game surface up to the window and shows them;
+        menus only update the parts of the window that changed since the last frame drawn for the same mode
+        """
+
+        nonlocal last_frame, last_frame_key, letterbox_key, frame_buffers, cropped_frame
+
+        monitor.begin("scale")
+        if last_frame is None:  # the display may have changed, so start again with new buffers and bars
+            frame_buffers = [Surface((RESOLUTION, RESOLUTION)).convert() for _ in range(2)]
+            cropped_frame = None
+            letterbox_key = None
+        frame = frame_buffers[last_frame is frame_buffers[0]]
+        if mode != "play":  # play mode covers the whole background
+            frame.blit(background, (0, 0))
+        frame.blit(game_surf, (0, 0))
+        changed = None
+        frame_key = (drawn_mode, Rect(game_screen), display.get_window_size())
+        if drawn_mode in MENU_MODES and last_frame is not None and frame_key == last_frame_key and not monitor.visible:
+            changed = mask.from_threshold(frame, (0, 0, 0), (1, 1, 1, 255), last_frame)
+            changed.invert()
+            changed = changed.get_bounding_rects()
+        last_frame, last_frame_key = frame, frame_key
+        if changed == []:
+            monitor.end()
+            return
+        mobile_play = IS_MOBILE and mode == "play"
+        if (frame_key[1:], mobile_play) != letterbox_key:  # the bars only need filling when the window changes
+            letterbox_key = (frame_key[1:], mobile_play)
+            if not mobile_play:
+                screen.fill(Color("black"))
+        if screen.get_rect().contains(game_screen):
+            # scale straight into the window to avoid allocating a window sized surface every frame
+            transform.scale(frame, game_screen.size, screen.subsurface(game_screen))
+        else:  # the window crops the game when there are no bars, which a subsurface can't hang over
+            if cropped_frame is None or cropped_frame.get_size() != game_screen.size:
+                cropped_frame = Surface(game_screen.size).convert()
+            transform.scale(frame, game_screen.size, cropped_frame)
+            screen.blit(cropped_frame, game_screen)
+        if changed is not None:
+            scale = game_screen.width / RESOLUTION
+            for i, rect in enumerate(changed):
+                left, top = floor(rect.left * scale), floor(rect.top * scale)
+                area = Rect(left, top, floor(rect.right * scale + 1) - left, floor(rect.bottom * scale + 1) - top)
+                changed[i] = area.move(game_screen.topleft).clip(game_screen).clip(screen.get_rect())
+        monitor.end()
+        monitor.begin("flip")
+        if changed is None:
             display.flip()
-        return game_surf
+        else:
+            display.update(changed)
+        monitor.end()
+
+    def get_framerate() -> int:
+        """
+        Returns the frame rate to hold the window to
+        """
+
+        if idle_frames > IDLE_DELAY:
+            return IDLE_FRAMERATE
+        return framerate
 
+    def is_idle() -> bool:
+        """
+        True when a menu would be drawn exactly the same as it was last frame
+        """
+
+        if mode not in MENU_MODES or last_frame is None or mode != last_frame_key[0] or monitor.visible:
+            return False
+        if event_keyboard or movement or quick_keys.current != quick_keys.last or ui.current != ui.last:
+            return False
+        if mode == "start":
+            return anim_timer <= 0
+        elif mode == "leaderboard":
+            return score_name is None
+        elif mode == "keybinds":
+            return keybind_select == 0
+        elif mode == "sound":
+            return not any(isinstance(widget, Slider) and widget.selected for widget in widgets[3])
+        return True
+
+    last_frame: Optional[Surface] = None  # the last frame shown and what it was shown for
+    last_frame_key: Tuple[str, Rect, Tuple[int, int]] = ("", Rect(0, 0, 0, 0), (0, 0))
+    letterbox_key: Optional[Tuple[Tuple[Rect, Tuple[int, int]], bool]] = None
+    frame_buffers: List[Surface] = []
+    cropped_frame: Optional[Surface] = None  # the game scaled up, for when it doesn't fit inside the window
+    logo_background = Surface((RESOLUTION, RESOLUTION))
+    idle_frames = 0
     bar_mode = 3
     screen_size = (500, 500)
+    if player is not None:
+        screen_size = tuple(player.header["window"])
     screen_full = False
     screen = display.get_surface()
     reset_screen()
@@ -1092,22 +2178,23 @@ async def main() -> None:
 
     # initialize sound
     def update_sound() -> None:
-        nonlocal playing_music
+        nonlocal playing_music, music_volume
 
         play_music = mode == "play" and (not pause) and player_sprite.mode != "gameover"
         if play_music != playing_music:
             if play_music:
                 playing_music = True
-                music.play(-1)
+                mixer.music.play(-1)
             else:
                 playing_music = False
-                music.stop()
-        music.set_volume(volume_music / 100)
-        for i in sfx.values():
-            i.set_volume(volume_effect / 100)
+                mixer.music.stop()
+        if volume_music != music_volume:
+            music_volume = volume_music
+            mixer.music.set_volume(volume_music / 100)
+        sfx.update(volume_effect / 100)
 
-    volume_music, volume_effect = 25, 50
     playing_music = False
+    music_volume: Optional[float] = None  # the volume the music was last set to
 
     # initialize user input
     def update_ui() -> None:
@@ -1124,10 +2211,7 @@ async def main() -> None:
         ui.update()
 
     def get_leaderboard_position() -> Optional[int]:
-        for i, line in enumerate(read(LEADERBOARD)):
-            if line == "" or score > int(line.split(":")[1]):
-                if line != "" or i < 5:
-                    return i
+        return leaderboard.get_position(score)
 
     def handle_tabs(number_of_buttons: int) -> None:
         nonlocal tabbed_widget
@@ -1194,6 +2278,70 @@ async def main() -> None:
     tabbed_widget = None
 
     # initialize sprites
+    def simulate(dt: float) -> None:
+        """
+        Advances the game by a single fixed length tick of dt milliseconds
+        """
+
+        nonlocal mode, level, player_y, player_last_y, player_total_y, ammo, throw_queued, levels_played, score_timer
+
+        if score_timer > 0:  # counted here so the score pops for as long when frames are skipped
+            score_timer -= dt
+        add = player_speed[1] * 128 * dt / 1000
+        player_y += add
+        player_total_y += add
+        if player_y > (level_lengths[level - 1]) * 16 + RESOLUTION * 1.5:
+            mode = "levelup"
+            level += 1
+            levels_played += 1
+            reset_level()
+            sfx["levelup"].play()
+            return
+        while player_y - player_last_y >= 16:
+            player_last_y += 16
+            if player_last_y <= (level_lengths[level - 1]) * 16 + RESOLUTION * 0.5:
+                monitor.begin("world")
+                world_load()
+                monitor.end()
+        if throw_queued:
+            throw_queued = False
+            if ammo == 0:
+                sfx["error"].play()
+            else:
+                player_sprite.costume = int(aim[0] < 0)
+                ammo -= 1
+                bread = Sprite(1, list(assets.frames["bread"]),
+                               Vector2(player_sprite.position) + Vector2(0, 4),
+                               update_bread)
+                bread.flip_costume = [aim[0] < 0, False]
+                bread.sprite_type, bread.velocity = S_BREAD, Vector2(aim) * 1.5 + player_speed
+                bread.mode = "up" if bread.velocity[1] > player_speed[1] else "down"
+                sprites.add(bread)
+        sprites.flush()
+        sprite_grid.rebuild(sprites)
+        for i in sprites.all():
+            i.update(i, dt)
+        for i in Sprite.integrate(chain.from_iterable(sprites.types[:S_PLAYER]), player_speed, dt):
+            i.delete(sprites)
+        sprites.flush()
+
+    def set_state(new_mode: Optional[str] = None, new_level: Optional[int] = None, new_pause: Optional[bool] = None,
+                  new_anim_timer: Optional[int] = None) -> None:
+        """
+        Overwrites some of the game's state, used by benchmarks to set up a scenario
+        """
+
+        nonlocal mode, level, pause, anim_timer
+
+        if new_mode is not None:
+            mode = new_mode
+        if new_level is not None:
+            level = new_level
+        if new_pause is not None:
+            pause = new_pause
+        if new_anim_timer is not None:
+            anim_timer = new_anim_timer
+
     def reset_game() -> None:
         nonlocal level, pause, last_score, score_i, score, ammo
 
@@ -1210,33 +2358,67 @@ async def main() -> None:
         reset_level()
 
     def reset_level() -> None:
-        nonlocal sprites, player_y, player_last_y, player_total_y, duck_speed
+        nonlocal player_y, player_last_y, player_total_y, duck_speed, world_generator, world_rows_left
 
-        sprites = [[] for _ in range(S_NUM_TYPES)]
-        sprites[S_PLAYER] += [player_sprite, player_tracks]
+        sprites.clear()
+        sprites.add(player_sprite)
+        sprites.add(player_tracks)
+        sprites.flush()
+        sprite_grid.rebuild(sprites)
         player_y = 0
         player_last_y = 0
         player_total_y = 0
         duck_speed = 0.05 + 0.05 * level
+        world_rows.clear()
+        world_rows_left = 0
+        if level <= len(level_lengths):
+            # every level gets its own random stream so generating ahead can't change what is generated
+            world_generator = generate_world(level, Random(world_random.getrandbits(64)))
+            world_rows_left = level_lengths[level - 1] + RESOLUTION // 32
+
+    def generate_world(world_level: int, generation_random: Random) -> Iterator[List[Sprite]]:
+        """
+        Endlessly generates the rows of a level, with the sprites positioned relative to the bottom of their row;
+        sprites are placed by checking a bitmap of the 4 pixel cells covered by the sprites generated before them
+        """
+
+        occupied: List[Dict[int, int]] = [{} for _ in range(S_NUM_TYPES)]  # bitmaps of every 4 pixel high line
+        row = 0
+
+        def get_cells(s: Sprite) -> Tuple[range, int]:
+            width, height = s.costumes[0].get_size()
+            left = max(0, floor(s.position[0]) + (RESOLUTION - width) // 2)
+            right = floor(s.position[0]) + (RESOLUTION + width) // 2
+            bottom = row * 16 + floor(s.position[1])
+            return range(bottom // 4, -(-(bottom + height) // 4)), (1 << -(-right // 4)) - (1 << left // 4)
+
+        def fits(s: Sprite, *sprite_types: int) -> bool:
+            lines, columns = get_cells(s)
+            return not any(occupied[sprite_type].get(line, 0) & columns
+                           for sprite_type in sprite_types for line in lines)
+
+        def occupy(s: Sprite) -> None:
+            lines, columns = get_cells(s)
+            bitmap = occupied[s.sprite_type]
+            for line in lines:
+                bitmap[line] = bitmap.get(line, 0) | columns
 
-    def world_load() -> None:
         def create_sprite(x: float, y: float):
             s = None
-            if randint(1, 50) == 1:
-                if randint(0, 1):  # OBSTACLES
-                    sheet = obstacles[level - 1]
-                    img = randint(0, len(sheet) - 1)
-                    s = Sprite(S_OBSTACLE, [sprite_sheet.subsurface(*sheet[img])],
+            if generation_random.randint(1, 50) == 1:
+                if generation_random.randint(0, 1):  # OBSTACLES
+                    sheet = assets.frames[f"obstacles {world_level}"]
+                    img = generation_random.randint(0, len(sheet) - 1)
+                    s = Sprite(S_OBSTACLE, [sheet[img]],
                                Vector2(x, y), update_obstacle)
-                    if level == 2 and img in (1, 2):
+                    if world_level == 2 and img in (1, 2):
                         s.mode = "vehicle"
-                    elif level == 3 and img < 2:  # create and set the image used for the building
+                    elif world_level == 3 and img < 2:  # create and set the image used for the building
                         # creates a list with images corresponding to parts of the building in the following order:
                         # [top_left, top_right, side_left, side_right, bottom_left, bottom_right]
-                        costumes = [transform.flip(sprite_sheet.subsurface(sheet[int(1 < i < 4)]), i % 2 == 1, i > 3)
-                                    for i in range(6)]
+                        costumes = [Sprite.flip_image(sheet[int(1 < i < 4)], i % 2 == 1, i > 3) for i in range(6)]
 
-                        height = randint(2, 4)
+                        height = generation_random.randint(2, 4)
                         s.costumes[0] = Surface((32, height * 16))
                         for layer in range(height):
                             if layer == 0:
@@ -1247,58 +2429,81 @@ async def main() -> None:
                                 costume = 2
                             s.costumes[0].blit(costumes[costume], (0, layer * 16))
                             s.costumes[0].blit(costumes[costume + 1], (16, layer * 16))
-                    if randint(0, 1):
+                        Sprite.invalidate_costume(s.costumes[0])
+                    if generation_random.randint(0, 1):
                         s.flip_horizontally()
-                    for obstacle in sprites[S_ROAD] + sprites[S_OBSTACLE] + sprites[S_LOAF] + sprites[S_DUCK]:
-                        if obstacle is not s and s.colliding(obstacle):
-                            s = None
-                            break
+                    if not fits(s, S_ROAD, S_OBSTACLE, S_LOAF, S_DUCK):
+                        s = None
                 else:
-                    if randint(1, 8) == 1:  # LOAF
-                        if randint(1, 10) == 1:
-                            s = Sprite(S_LOAF, [sprite_sheet.subsurface(32, 32, 16, 16)], Vector2(x, y), update_cannon)
+                    if generation_random.randint(1, 8) == 1:  # LOAF
+                        if generation_random.randint(1, 10) == 1:
+                            s = Sprite(S_LOAF, list(assets.frames["cannon"]), Vector2(x, y), update_cannon)
                         else:
-                            s = Sprite(S_LOAF, [sprite_sheet.subsurface(16, 40, 16, 8)], Vector2(x, y), update_loaf)
-                        for obstacle in sprites[S_ROAD] + sprites[S_OBSTACLE]:
-                            if s.colliding(obstacle):
-                                s = None
-                                break
+                            s = Sprite(S_LOAF, list(assets.frames["loaf"]), Vector2(x, y), update_loaf)
+                        if not fits(s, S_ROAD, S_OBSTACLE):
+                            s = None
                     else:  # DUCK
-                        s = Sprite(S_DUCK, [sprite_sheet.subsurface(0, 16, 16, 16),
-                                            sprite_sheet.subsurface(16, 16, 16, 16),
-                                            sprite_sheet.subsurface(32, 16, 16, 16),
-                                            sprite_sheet.subsurface(48, 16, 16, 16)], Vector2(x, y), update_duck)
-                        s.bonus, s.timer, s.mode, s.feet, s.feet_frame = 0, 0, "land", feet, 0
-                        if randint(0, 1):
+                        s = Sprite(S_DUCK, list(assets.frames["duck"]), Vector2(x, y), update_duck)
+                        s.bonus, s.timer, s.mode, s.feet, s.feet_frame = 0, 0, "land", assets.frames["feet"], 0
+                        if generation_random.randint(0, 1):
                             s.flip_horizontally()
-            elif randint(1, 20) == 1:
-                sheet = decorators[level - 1]
-                s = Sprite(S_DECORATOR, [sprite_sheet.subsurface(i) for i in sheet],
-                           Vector2(x + randint(0, 1) * 8, y + randint(0, 1) * 8), update_decorator)
-                s.costume = randint(0, 1)
-                if randint(0, 1):
+            elif generation_random.randint(1, 20) == 1:
+                s = Sprite(S_DECORATOR, list(assets.frames[f"decorators {world_level}"]),
+                           Vector2(x + generation_random.randint(0, 1) * 8, y + generation_random.randint(0, 1) * 8),
+                           update_decorator)
+                s.costume = generation_random.randint(0, 1)
+                if generation_random.randint(0, 1):
                     s.flip_horizontally()
-                for obstacle in sprites[S_ROAD]:
-                    if s.colliding(obstacle):
-                        s = None
-                        break
+                if not fits(s, S_ROAD):
+                    s = None
             if s:
-                sprites[s.sprite_type].insert(0, s)
+                occupy(s)
+                row_sprites.append(s)
 
         length = RESOLUTION // 16
-        if level == 3 and randint(1, 20) == 1:
-            r = Sprite(S_ROAD, [road_img], Vector2(0, 256 - (player_y % 16)), update_road)
-            r.timer = randint(15, 25) * 100
-            sprites[r.sprite_type].insert(0, r)
-        else:
-            for x_position in range(length):
-                create_sprite((x_position - length // 2 + 0.5) * 16, 256 - (player_y % 16))
+        while True:
+            row_sprites = []
+            if world_level == 3 and generation_random.randint(1, 20) == 1:
+                r = Sprite(S_ROAD, [road_img], Vector2(0, 0), update_road)
+                r.timer = generation_random.randint(15, 25) * 100
+                occupy(r)
+                row_sprites.append(r)
+            else:
+                for x_position in range(length):
+                    create_sprite((x_position - length // 2 + 0.5) * 16, 0)
+            yield row_sprites
+            row += 1
+
+    def pregenerate(deadline: Optional[float] = None) -> None:
+        """
+        Generates rows of the level ahead of the player until the whole level is built or the deadline is reached
+        """
+
+        nonlocal world_rows_left
+
+        while world_rows_left > 0 and (deadline is None or perf_counter() < deadline):
+            world_rows.append(next(world_generator))
+            world_rows_left -= 1
+
+    def world_load() -> None:
+        """
+        Adds the next generated row of the level to the top of the screen, generating it first if it isn't ready
+        """
+
+        nonlocal world_rows_left
 
-    def update_player(self: Sprite) -> None:
+        if not world_rows:
+            world_rows.append(next(world_generator))
+            world_rows_left -= 1
+        for s in world_rows.popleft():
+            s.position[1] += RESOLUTION - (player_y % 16)
+            sprites.add(s, front=True)
+
+    def update_player(self: Sprite, dt: float) -> None:
         nonlocal mode, pause, score_name
 
         if self.mode == "gameover":
-            self.timer -= clock.get_time()
+            self.timer -= dt
             if self.timer <= 0:
                 if get_leaderboard_position() is not None:
                     mode = "leaderboard"
@@ -1306,55 +2511,45 @@ async def main() -> None:
                 else:
                     mode = "gameover"
             self.position[1] += 5
-        if fps > 0:
-            player_speed[1] = 0.5 + player_total_y / (total_length * 32)
-            if IS_MOBILE and not pause:
-                mx = 0
-                if quick_keys.pressed("Click"):
-                    mx = quick_keys.current[2]
-                    mx = mobile_box[1].collidepoint(mx) - mobile_box[0].collidepoint(mx)
-            else:
-                mx = ui.pressed("Right") - ui.pressed("Left")
-            m = Vector2(mx, 0) * 128 / fps
-            if abs(self.position[0] + m[0]) > 120:
-                m[0] = copysign(120, self.position[0]) - self.position[0]
-            self.move_by(m)
-            if mx != 0:
-                self.costume = int(mx < 0)
-
-    def update_tracks(self: Sprite) -> None:
+        player_speed[1] = 0.5 + player_total_y / (total_length * 32)
+        if IS_MOBILE and not pause:
+            mx = 0
+            if quick_keys.pressed("Click"):
+                mx = quick_keys.current[2]
+                mx = mobile_box[1].collidepoint(mx) - mobile_box[0].collidepoint(mx)
+        else:
+            mx = ui.pressed("Right") - ui.pressed("Left")
+        m = Vector2(mx, 0) * 128 * dt / 1000
+        if abs(self.position[0] + m[0]) > 120:
+            m[0] = copysign(120, self.position[0]) - self.position[0]
+        self.move_by(m)
+        if mx != 0:
+            self.costume = int(mx < 0)
+
+    def update_tracks(self: Sprite, dt: float) -> None:
         if player_sprite.mode == "gameover":
             self.costume = 3
             self.flip_costume = player_sprite.flip_costume
         else:
             self.costume = level - 1
-            self.timer -= clock.get_time()
+            self.timer -= dt
             if self.timer <= 0:
                 self.timer = 80
                 self.flip_horizontally()
 
-    def update_sprite(self: Sprite) -> None:
-        if fps > 0:
-            self.velocity *= 0.99
-            self.move_by((self.velocity - player_speed) * 128 / fps)
-        if abs(self.position[0]) > 144 or self.position[1] < -64:
-            self.delete(sprites)
-
-    def update_loaf(self: Sprite) -> None:
+    def update_loaf(self: Sprite, dt: float) -> None:
         nonlocal ammo
 
-        update_sprite(self)
         if self.colliding(player_sprite, player_tracks):
             ammo += 6
             sfx["error"].play()
             self.delete(sprites)
             return
 
-    def update_bread(self: Sprite) -> None:
+    def update_bread(self: Sprite, dt: float) -> None:
         nonlocal score, ammo, player_speed, score_timer
 
-        update_sprite(self)
-        for i in sprites[S_DUCK]:
+        for i in sprite_grid.query(self, S_DUCK):
             if self.colliding(i):
                 score_timer += 250
                 if i.bonus > 0:
@@ -1362,7 +2557,7 @@ async def main() -> None:
                 score += 1
                 i.bonus += 1
                 i.mode = "full"
-                sfx[("quack1", "quack2")[randint(0, 1)]].play()
+                sfx[("quack1", "quack2")[behaviour_random.randint(0, 1)]].play()
                 self.delete(sprites)
                 return
         if (self.mode == "up" and self.velocity[1] < player_speed[1]) and self.colliding(player_sprite, player_tracks):
@@ -1371,39 +2566,40 @@ async def main() -> None:
             self.delete(sprites)
             return
 
-    def update_cannon(self: Sprite) -> None:
+    def update_cannon(self: Sprite, dt: float) -> None:
         nonlocal ammo
 
         if self.timer is not None:
-            self.timer -= clock.get_time()
+            self.timer -= dt
             if self.timer < 0:
                 self.delete(sprites)
                 return
             else:
                 self.costumes[self.costume].set_alpha(self.timer / 500 * 255)
+                Sprite.invalidate_costume(self.costumes[self.costume])
         elif self.colliding(player_sprite, player_tracks):
             ammo += 12
             for i in sprites[S_DUCK]:
-                aim_ = (i.position - self.position) / randint(20, 22)
-                bread_ = Sprite(1, [sprite_sheet.subsurface(0, 32, 16, 16)],
+                aim_ = (i.position - self.position) / behaviour_random.randint(20, 22)
+                bread_ = Sprite(1, list(assets.frames["bread"]),
                                 Vector2(self.position),
                                 update_bread)
                 bread_.flip_costume = [aim_[0] < 0, False]
                 bread_.sprite_type, bread_.velocity = S_BREAD, Vector2(aim_) + player_speed
                 bread_.mode = "up" if bread_.velocity[1] > player_speed[1] else "down"
-                sprites[S_BREAD].append(bread_)
+                sprites.add(bread_)
             sfx["cannon"].play()
             self.timer = 500
-        update_sprite(self)
+            self.costumes[self.costume] = self.costumes[self.costume].copy()  # fade a copy of the shared frame
 
-    def update_duck(self: Sprite) -> None:
+    def update_duck(self: Sprite, dt: float) -> None:
         nonlocal score
 
         if self.timer >= 0:
-            self.timer -= clock.get_time()
+            self.timer -= dt
         if self.mode == "full":
             self.feet_frame = 300
-            self.costume = (self.timer // 100) % 3 + 1
+            self.costume = int(self.timer // 100) % 3 + 1
             self.velocity = Vector2(self.flip_costume[0] * -4 + 2, 2)
         else:
             if self.mode == "hit":
@@ -1411,14 +2607,14 @@ async def main() -> None:
                 if self.timer < 0:
                     self.mode = "land"
                 else:
-                    self.costume = (self.timer // 100) % 3 + 1
+                    self.costume = int(self.timer // 100) % 3 + 1
             elif self.mode == "land":
                 if self.timer < 0:
-                    self.timer = randint(750, 1250)
-                    self.velocity += Vector2(randint(-3, 3) * duck_speed, 0)
+                    self.timer = behaviour_random.randint(750, 1250)
+                    self.velocity += Vector2(behaviour_random.randint(-3, 3) * duck_speed, 0)
                     self.flip_costume[0] = self.velocity[0] < 0
                 if self.velocity.length() > 0.05:
-                    self.feet_frame += clock.get_time()
+                    self.feet_frame += dt
                     self.feet_frame %= 300
                 else:
                     self.feet_frame = 0
@@ -1431,83 +2627,64 @@ async def main() -> None:
                 self.timer = 1000
                 self.velocity[0] += copysign(player_speed[1], self.position.x - player_sprite.position.x)
                 self.position += self.velocity
-        for obstacle in sprites[S_OBSTACLE] + sprites[S_LOAF] + sprites[S_DUCK]:
-            if obstacle is not self and self.colliding(obstacle):
+        for obstacle in sprite_grid.query(self, S_OBSTACLE, S_LOAF, S_DUCK):
+            if self.colliding(obstacle):
                 self.velocity += (self.position - obstacle.position) / 100
-        update_sprite(self)
 
-    def update_obstacle(self: Sprite) -> None:
+    def update_obstacle(self: Sprite, dt: float) -> None:
         if self.mode == "vehicle":
             self.velocity[0] = 0.25 * (1 - (self.flip_costume[0] * 2))
-        if player_sprite.mode != "gameover" and self.colliding(player_sprite, player_tracks):
+        if not immortal and player_sprite.mode != "gameover" and self.colliding(player_sprite, player_tracks):
             player_sprite.timer = 1000
             player_sprite.mode = "gameover"
             player_speed[1] = 0
             sfx["gameover"].play()
-        update_sprite(self)
 
-    def update_road(self: Sprite) -> None:
-        self.timer -= clock.get_time()
+    def update_road(self: Sprite, dt: float) -> None:
+        self.timer -= dt
         if self.timer <= 0:
-            self.timer = randint(11, 20) * 100
+            self.timer = behaviour_random.randint(11, 20) * 100
 
-            s = Sprite(S_OBSTACLE, [sprite_sheet.subsurface(0, 96, 32, 16), sprite_sheet.subsurface(32, 96, 32, 16)],
-                       Vector2(self.position), update_obstacle)
-            s.mode, s.costume = "vehicle", randint(0, 1)
-            if randint(0, 1):
+            s = Sprite(S_OBSTACLE, list(assets.frames["vehicle"]), Vector2(self.position), update_obstacle)
+            s.mode, s.costume = "vehicle", behaviour_random.randint(0, 1)
+            if behaviour_random.randint(0, 1):
                 s.flip_horizontally()
             s.position[0] = (RESOLUTION + 32) * (s.flip_costume[0] - 0.5)
-            sprites[s.sprite_type].insert(0, s)
+            sprites.add(s, front=True)
 
-        update_sprite(self)
-
-    def update_decorator(self: Sprite) -> None:
+    def update_decorator(self: Sprite, dt: float) -> None:
         if level == 2:
             if self.timer is None:
                 self.timer = 0
-            self.timer += clock.get_time()
-            self.costume = (self.timer // 100) % 4
+            self.timer += dt
+            self.costume = int(self.timer // 100) % 4
         elif self.mode == "crushed" and self.timer is not None:
-            self.timer += clock.get_time()
+            self.timer += dt
             if self.mode == "crushed" and self.timer >= 200:
                 self.timer = None
                 self.costume = 3
             else:
                 self.costume = 2
         elif self.mode != "crushed":
-            for entity in sprites[S_DUCK] + sprites[S_PLAYER]:
+            for entity in sprite_grid.query(self, S_DUCK, S_PLAYER):
                 if self.colliding(entity) and entity.mode != "full":
                     self.timer = 0
                     self.mode = "crushed"
-                    sfx[("grass1", "grass2")[randint(0, 1)]].play()
-        update_sprite(self)
-
-    player_sprite = Sprite(S_PLAYER, [sprite_sheet.subsurface(0, 0, 16, 16),
-                                      sprite_sheet.subsurface(16, 0, 16, 16)], Vector2(0, 8), update_player)
-    player_tracks = Sprite(S_PLAYER,
-                           [sprite_sheet.subsurface(32, 0, 16, 8), sprite_sheet.subsurface(48, 0, 16, 8),
-                            sprite_sheet.subsurface(32, 8, 16, 8), sprite_sheet.subsurface(48, 8, 16, 8)],
-                           player_sprite.position, update_tracks)
+                    sfx[("grass1", "grass2")[behaviour_random.randint(0, 1)]].play()
+
+    player_sprite = Sprite(S_PLAYER, list(assets.frames["player"]), Vector2(0, 8), update_player)
+    player_tracks = Sprite(S_PLAYER, list(assets.frames["tracks"]), player_sprite.position, update_tracks)
     player_tracks.timer = 0
     aim = Vector2(0, 1)
     road_img = Surface((RESOLUTION, 16))
-    road_sheet = sprite_sheet.subsurface(0, 64, 16, 16)
     for road_x in range(0, RESOLUTION, 16):
-        road_img.blit(road_sheet, (road_x, 0))
-    del road_sheet
-    decorators = (((0, 128, 8, 8), (8, 128, 8, 8), (0, 136, 8, 8), (8, 136, 8, 8)),
-                  ((16, 128, 8, 8), (24, 128, 8, 8), (16, 136, 8, 8), (24, 136, 8, 8)),
-                  ((0, 128, 8, 8), (8, 128, 8, 8), (0, 136, 8, 8), (8, 136, 8, 8)))
-    obstacles = (((32, 48, 16, 32), (0, 80, 32, 16), (32, 80, 16, 16), (48, 80, 16, 16)),
-                 ((32, 128, 16, 16), (0, 112, 32, 16), (32, 112, 32, 16)),
-                 ((48, 48, 16, 16), (48, 64, 16, 16), (32, 48, 16, 32), (32, 80, 16, 16)))
-    feet = (sprite_sheet.subsurface(48, 32, 8, 8), sprite_sheet.subsurface(56, 32, 8, 8),
-            sprite_sheet.subsurface(48, 40, 8, 8), sprite_sheet.subsurface(56, 40, 8, 8))
+        road_img.blit(assets.frames["road"][0], (road_x, 0))
 
     # automatically reset variables
     level = 0
     pause = False
-    sprites: List[List[Sprite]] = []
+    sprites = SpriteStore()
+    sprite_grid = SpatialHash()
     last_score = ""
     score_i = 0
     score = 0
@@ -1516,6 +2693,9 @@ async def main() -> None:
     player_last_y = 0
     player_total_y = 0
     duck_speed = 0
+    world_generator: Optional[Iterator[List[Sprite]]] = None
+    world_rows: Deque[List[Sprite]] = deque()  # rows generated ahead of the player
+    world_rows_left = 0  # rows of the level that have yet to be generated
 
     # reset variables
     new_mode = ""
@@ -1526,23 +2706,68 @@ async def main() -> None:
     score_timer = 0
     anim_timer = 5000
     total_time = 0
-    transition1 = Surface((0, 0))
-    transition2 = Surface((0, 0))
+    transition: Optional[Surface] = None  # the old and new screens side by side, scrolled across during transitions
+    snapshots: Dict[str, Tuple[tuple, Surface]] = {}  # images of menu screens and what they were drawn showing
     background = Surface((RESOLUTION, RESOLUTION))
+    game_layer = Surface((RESOLUTION, RESOLUTION)).convert_alpha()
     trans_dir = 1
     mode = "logo"
-    clock = time.Clock()
+    clock = FramePacer()
     event_keyboard = []
     movement = Vector2(0, 0)
     player_speed = Vector2(0, 0)
     last_aim = Vector2(0, 0)
+    tick_time = 1000 / TICK_RATE
+    tick_accumulator = 0
+    throw_queued = False
+    frame = 0
+    levels_played = 0
+    deaths = 0
+    frame_time = 0
+    monitor = PerformanceMonitor(hud, hud_csv)
+    if headless:
+        clock = SimulatedClock()
+        mode = "play"
+    if player is not None:
+        mode = player.header["mode"]
+    if mode == "play":
+        reset_game()
+    startup_time = perf_counter() - load_start
+    if benchmark is not None:
+        return benchmark(SimpleNamespace(
+            startup_time=startup_time,
+            get_sprites=lambda: sprites, get_screen=lambda: screen, get_mode=lambda: mode, set_state=set_state,
+            update=update, present=present, trans=trans, simulate=simulate, world_load=world_load,
+            pregenerate=pregenerate, reset_game=reset_game, reset_level=reset_level,
+            get_leaderboard_position=get_leaderboard_position, tick_time=tick_time, sprite_grid=sprite_grid,
+            player_sprite=player_sprite, player_tracks=player_tracks,
+            quick_keys=quick_keys, ui=ui, assets=assets, road_img=road_img, use_font=use_font,
+            score_font=score_font, sfx=sfx, update_duck=update_duck, update_cannon=update_cannon,
+            update_obstacle=update_obstacle, update_road=update_road))
+    recorder = None
+    if record:
+        recorder = InputRecorder(record, {"seed": seed, "mode": mode, "window": list(screen_size),
+                                          "headless": headless})
+    start_time = perf_counter()
     while mode != "quit":
+        frame_start = perf_counter()
         #  get user input
-        quick_keys.update()
-        if ui is not quick_keys:
-            ui.update()
+        monitor.begin("input")
+        frame_time = clock.get_time()
+        if player is None:
+            quick_keys.update()
+            if ui is not quick_keys:
+                ui.update()
+        elif player.next():
+            frame_time = player.frame_time
+            quick_keys.update(player.states[0])
+            if ui is not quick_keys:
+                ui.update(player.states[-1])
+        else:
+            break
         event_keyboard.clear()
         movement.update(0, 0)
+        key_events = []
         if quick_keys.pressed("Escape"):
             mode = "quit"
         else:
@@ -1551,14 +2776,29 @@ async def main() -> None:
                     mode = "quit"
                     break
                 elif e.type == KEYDOWN:
-                    event_keyboard.append(e.key)
-                    if score_name is not None:
-                        if e.key == K_BACKSPACE:
-                            score_name = score_name[:-1]
-                        elif e.unicode.isalpha() or e.unicode in "-_":
-                            score_name += e.unicode.capitalize()
+                    key_events.append((e.key, e.unicode))
                 elif e.type == MOUSEMOTION:
                     movement.update(e.rel)
+                elif e.type in JOYSTICK_EVENTS:
+                    for u in uis:
+                        u.handle_event(e)
+                elif e.type in (WINDOWEXPOSED, WINDOWSIZECHANGED, WINDOWRESTORED):
+                    last_frame = None
+            if player is not None:
+                key_events = player.key_events
+                movement.update(player.movement)
+            for key_code, unicode in key_events:
+                event_keyboard.append(key_code)
+                if score_name is not None:
+                    if key_code == K_BACKSPACE:
+                        score_name = score_name[:-1]
+                    elif unicode.isalpha() or unicode in "-_":
+                        score_name += unicode.capitalize()
+        if recorder is not None:
+            recorder.record(frame_time, (quick_keys, ui)[:1 + (ui is not quick_keys)], key_events, movement)
+        if PERFORMANCE_HUD_KEY in event_keyboard:
+            monitor.visible = not monitor.visible
+        monitor.end()
         if mode != "quit":
             if not IS_WEB:
                 if quick_keys.tapped("F10"):
@@ -1567,12 +2807,11 @@ async def main() -> None:
                     fullscreen()
 
             # run program
-            fps = clock.get_fps()
             if mode == "start":
                 if quick_keys.any(event_keyboard, movement):
                     leaderboard_timer = 10000
                 else:
-                    leaderboard_timer -= clock.get_time()
+                    leaderboard_timer -= frame_time
                     if leaderboard_timer <= 0:
                         mode = "leaderboard"
             elif mode == "keybinds":
@@ -1589,45 +2828,93 @@ async def main() -> None:
                 if quick_keys.tapped("Menu") or (IS_MOBILE and quick_keys.tapped("Click") and mobile_box[2].collidepoint(quick_keys.current[2])):
                     pause = not pause
                 if not pause:
-                    if fps > 0:
-                        add = player_speed[1] * 128 / fps
-                        player_y += add
-                        player_total_y += add
-                        if player_y > (level_lengths[level - 1]) * 16 + RESOLUTION * 1.5:
-                            mode = "levelup"
-                            level += 1
-                            reset_level()
-                            sfx["levelup"].play()
-                        else:
-                            while player_y - player_last_y >= 16:
-                                player_last_y += 16
-                                if player_last_y <= (level_lengths[level - 1]) * 16 + RESOLUTION * 0.5:
-                                    world_load()
                     aim_init = ui.get_cursor("Aim", player_sprite.position + Vector2(0, 8), bar_mode)
                     if aim_init != (0, 0):
                         aim.update(aim_init)
                     del aim_init
                     if ui.tapped("Throw") and not (player_sprite.mode == "gameover" or (IS_MOBILE and any([i.collidepoint(quick_keys.current[2]) for i in mobile_box]))):
-                        if ammo == 0:
-                            sfx["error"].play()
-                        else:
-                            player_sprite.costume = int(aim[0] < 0)
-                            ammo -= 1
-                            bread = Sprite(1, [sprite_sheet.subsurface(0, 32, 16, 16)],
-                                           Vector2(player_sprite.position) + Vector2(0, 4),
-                                           update_bread)
-                            bread.flip_costume = [aim[0] < 0, False]
-                            bread.sprite_type, bread.velocity = S_BREAD, Vector2(aim) * 1.5 + player_speed
-                            bread.mode = "up" if bread.velocity[1] > player_speed[1] else "down"
-                            sprites[S_BREAD].append(bread)
+                        throw_queued = True
+
+                    # run as many fixed length ticks as fit in the time the last frame took
+                    tick_accumulator += min(frame_time, MAX_FRAME_TIME) * TICK_RATE  # milliseconds * TICK_RATE
+                    monitor.begin("simulation")
+                    while tick_accumulator >= 1000 and mode == "play":
+                        tick_accumulator -= 1000
+                        simulate(tick_time)
+                    monitor.end()
 
             # update user output
-            update()
+            monitor.begin("draw")
+            if is_idle():
+                idle_frames += 1
+            elif mode != "play" or pause or (render and (headless or not clock.behind(get_framerate()))):
+                idle_frames = 0
+                update()
             update_sound()
-            clock.tick(60)
-            await asyncio.sleep(0)
+            monitor.end()
+            if mode != "play":  # sound effects are decoded a frame at a time during the splash and menus
+                sfx.preload()
+            if not headless:  # headless frames have no spare time, so rows are only generated once they are needed
+                monitor.begin("world")
+                pregenerate(frame_start + WORLD_GENERATION_BUDGET / (get_framerate() or FRAMERATE))
+                monitor.end()
+            monitor.begin("wait")
+            if headless:
+                clock.tick()
+                frame += 1
+                if player is None or player.header["headless"]:  # recorded sessions are replayed as they were
+                    if mode == "levelup":
+                        mode = "play"
+                    elif mode in ("leaderboard", "gameover"):  # start again instead of entering a name
+                        deaths += 1
+                        mode = "play"
+                        reset_game()
+                    if level > len(level_lengths):
+                        reset_game()
+                if (frames and frame >= frames) or (levels and levels_played >= levels):
+                    mode = "quit"
+            else:
+                await clock.tick(get_framerate())
+            monitor.end()
+            monitor.end_frame(sprites)
+    monitor.close()
+    if recorder is not None:
+        recorder.save()
+    if headless:
+        wall_time = perf_counter() - start_time
+        return {"frames": frame, "levels": levels_played, "deaths": deaths, "score": score, "wall_time": wall_time,
+                "simulated_time": clock.ticks / 1000, "fps": frame / wall_time if wall_time else 0.0,
+                "startup_time": startup_time, "memory": get_peak_memory()}
     if IS_WEB:
         await main()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    if IS_WEB:
+        asyncio.run(main())
+    else:
+        parser = ArgumentParser(description="Roboduck")
+        parser.add_argument("--headless", action="store_true",
+                            help="run the play loop without a window as fast as possible")
+        parser.add_argument("--frames", type=int, default=0, help="number of frames to simulate when headless")
+        parser.add_argument("--levels", type=int, default=0,
+                            help="number of levels to simulate when headless, with a player that can't crash")
+        parser.add_argument("--no-render", action="store_true", help="skip drawing when headless")
+        parser.add_argument("--seed", type=int, help="seed for the world generation and behaviour random numbers")
+        parser.add_argument("--record", metavar="FILE", help="record every frame of user-input to a file")
+        parser.add_argument("--replay", metavar="FILE", help="play back user-input recorded with --record")
+        parser.add_argument("--hud", action="store_true", help="start with the performance overlay shown (F3)")
+        parser.add_argument("--hud-csv", metavar="FILE", help="log the performance overlay's timings to a CSV file")
+        parser.add_argument("--fps", type=int, default=FRAMERATE, choices=FRAMERATES,
+                            help="frame rate to draw the game at, 0 for as fast as possible")
+        args = parser.parse_args()
+        if args.headless and not (args.frames or args.levels or args.replay):
+            args.frames = 3600
+        stats = asyncio.run(main(args.headless, args.frames, args.levels, not args.no_render,
+                                 args.seed, args.record, args.replay, hud=args.hud, hud_csv=args.hud_csv,
+                                 framerate=args.fps))
+        if stats:
+            print(f"{stats['frames']} frames ({stats['simulated_time']:.1f}s of play, {stats['levels']} levels, "
+                  f"{stats['deaths']} deaths) in {stats['wall_time']:.2f}s: {stats['fps']:.1f} frames per second")
+            print(f"started in {stats['startup_time']:.2f}s"
+                  + (f", peaked at {stats['memory']:.1f} MB resident" if stats["memory"] is not None else ""))